@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 import argparse
+import json
 import os
+import Queue
+import re
+import sys
+import threading
 import time
 import utils
+import uuid
 import yaml
 from novaclient import client as novaclient
+from novaclient import exceptions as nova_exceptions
+from novaclient import utils as nova_utils
 
 """
 Parses a specification of nodes to install and makes it so
@@ -19,11 +27,85 @@ def get_nova_creds_from_env():
     d['region_name'] = os.environ.get('OS_REGION_NAME')
     return d
 
+class RateLimiter(object):
+    """
+    Spaces out calls to wait() so that, across all threads, they return
+    at most rate times per second. No rate means no limit.
+    """
+    def __init__(self, rate=None):
+        self.interval = rate and 1.0 / rate or 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def run_pool(func, items, concurrency=1, rate_limit=None):
+    """
+    Call func on each of items from up to concurrency threads, starting at
+    most rate_limit calls per second, and return the results in the order
+    of items. Once a call raises, no more are started, and the first
+    exception is re-raised when the running ones are done.
+    """
+    limiter = RateLimiter(rate_limit)
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while not errors:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            limiter.wait()
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    if concurrency <= 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(concurrency, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
 class ApplyResources(object):
-    def __init__(self):
+    # Seconds between polls while waiting for servers to build. Polling
+    # backs off from POLL_MIN to POLL_MAX while nothing changes.
+    POLL_MIN = 1
+    POLL_MAX = 10
+
+    def __init__(self, lookup_cache_path=None, lookup_cache_ttl=3600):
+        """
+        Image, flavor and network names are resolved to ids once per run.
+        With lookup_cache_path, the ids are also kept in that file and
+        reused by later runs against the same cloud (auth URL, region and
+        tenant) for lookup_cache_ttl seconds.
+        """
         self.nova_client = None
-        self._images = {}
-        self._flavors = {}
+        self.lookup_cache_path = lookup_cache_path
+        self.lookup_cache_ttl = lookup_cache_ttl
+        # '<kind>:<name>' -> (id, when it was resolved)
+        self._lookups = {}
+        if lookup_cache_path:
+            self._lookups = self.read_lookup_cache()
 
     def read_resources(self, path):
         fp = file(path)
@@ -40,16 +122,26 @@ class ApplyResources(object):
 
     def get_existing_servers(self, project_tag=None, attr_name='name'):
         """
-        This method accepts an option project tag
+        This method accepts an option project tag. If attr_name is None,
+        the servers themselves are returned.
         """
         # NOTE we should check for servers only in a certain state
         nova_client = self.get_nova_client()
         servers = nova_client.servers.list()
         if project_tag:
             servers = [elem for elem in servers if elem.name.endswith('_' + project_tag) ]
+        if attr_name is None:
+            return servers
         return [getattr(s, attr_name) for s in servers]
 
 
+    def project_search_opts(self, project_tag):
+        """
+        Server list options selecting the servers of the project tagged
+        project_tag (or all of them). nova matches names as a regex.
+        """
+        return project_tag and {'name': '_%s$' % re.escape(project_tag)} or {}
+
     def generate_desired_servers(self, resources, mappings={}, project_tag=None, number_overrides={}):
         """
         Convert from a hash of servers resources to the
@@ -77,36 +169,97 @@ class ApplyResources(object):
         desired_servers = self.generate_desired_servers(resources, mappings, project_tag, number_overrides=number_overrides)
         return [elem for elem in desired_servers if elem['name'] not in existing_servers ]
 
-    def create_servers(self, servers, userdata, key_name=None):
+    def create_servers(self, servers, userdata, key_name=None, concurrency=1, rate_limit=None,
+                       project_tag=None, timeout=3600):
+        """
+        Create servers, sending up to concurrency create requests to nova
+        at once but no more than rate_limit per second, then wait up to
+        timeout seconds for them to build (see wait_for_servers) and assign
+        floating IPs where asked to. Raises an exception if any of them
+        failed to build, disappeared or was still building.
+        """
+        self.resolve_all(servers, concurrency)
+
+        def create(s):
+            userdata_file = file(userdata)
+            return self.create_server(userdata_file, key_name, **s)
+
+        server_ids = run_pool(create, servers, concurrency, rate_limit)
 
-        ids = set()
+        names = {}
         floating_ip_servers = set()
-        for s in servers:
-            userdata_file = file(userdata)
-            server_id = self.create_server(userdata_file, key_name, **s)
-            ids.add(server_id)
+        for s, server_id in zip(servers, server_ids):
+            names[server_id] = s['name']
 
             if s.get('assign_floating_ip'):
                 floating_ip_servers.add(server_id)
 
         nova_client = self.get_nova_client()
+        built = self.wait_for_servers(names.keys(), project_tag, timeout)
+        built = dict((server_id, instance) for server_id, instance in built.iteritems()
+                     if instance.status not in ('BUILD', 'ERROR'))
 
-        done = set()
-        while ids:
-            time.sleep(5)
-            for id in ids:
-                instance = nova_client.servers.get(id)
-                print "%s (%s): %s" % (instance.name, id, instance.status)
-                if instance.status != 'BUILD':
-                    done.add(id)
-            ids = ids.difference(done)
-
-        for server_id in floating_ip_servers:
+        for server_id in floating_ip_servers.intersection(built):
+            instance = built[server_id]
             ip = nova_client.floating_ips.create()
-            instance = nova_client.servers.get(server_id)
-            print "Assigning %s to %s (%s)" % (ip.ip, instance.name, id)
+            print "Assigning %s to %s (%s)" % (ip.ip, instance.name, server_id)
             instance.add_floating_ip(ip.ip)
 
+        failed = sorted(name for server_id, name in names.iteritems() if server_id not in built)
+        if failed:
+            raise Exception('Failed to build: %s' % ', '.join(failed))
+
+    def wait_for_servers(self, ids, project_tag=None, timeout=None):
+        """
+        Wait for the servers with the given ids to leave the BUILD state,
+        polling with one detailed server list (of just the project's
+        servers, given project_tag) at a time. Servers missing from the
+        list are fetched one by one. Servers that go to ERROR or turn out
+        to be deleted are reported as soon as they are seen. Gives up
+        after timeout seconds.
+
+        Returns a dict mapping each id to its server as last listed,
+        leaving out deleted servers.
+        """
+        nova_client = self.get_nova_client()
+        search_opts = self.project_search_opts(project_tag)
+        pending = set(ids)
+        found = {}
+        delay = self.POLL_MIN
+        deadline = timeout and time.time() + timeout
+        while pending:
+            if deadline and time.time() >= deadline:
+                print "Timed out waiting for: %s" % ', '.join(
+                    '%s (%s)' % (found[i].name, i) if i in found else i for i in sorted(pending))
+                break
+            time.sleep(delay)
+            changed = False
+            listed = list(nova_client.servers.list(detailed=True, search_opts=search_opts))
+            missing = pending.difference(server.id for server in listed)
+            for server_id in sorted(missing):
+                try:
+                    listed.append(nova_client.servers.get(server_id))
+                except nova_exceptions.NotFound:
+                    changed = True
+                    print "%s: deleted" % (server_id,)
+                    pending.discard(server_id)
+                    found.pop(server_id, None)
+            for server in listed:
+                if server.id not in pending:
+                    continue
+                if server.id not in found or found[server.id].status != server.status:
+                    changed = True
+                    print "%s (%s): %s" % (server.name, server.id, server.status)
+                    if server.status == 'ERROR':
+                        fault = getattr(server, 'fault', None) or {}
+                        print "%s (%s) failed to build: %s" % (server.name, server.id,
+                                                               fault.get('message', 'unknown error'))
+                found[server.id] = server
+                if server.status != 'BUILD':
+                    pending.discard(server.id)
+            delay = changed and self.POLL_MIN or min(delay * 2, self.POLL_MAX)
+        return found
+
 
     def create_server(self,
                       userdata_file,
@@ -119,13 +272,11 @@ class ApplyResources(object):
                       **keys):
         print "Creating server %s"%(name)
         nova_client = self.get_nova_client()
-        self._images[image] = self._images.get(image, nova_client.images.get(image))
-        self._flavors[flavor] = self._flavors.get(flavor, nova_client.flavors.get(flavor))
-        net_list = networks and ([{'net-id': n} for n in networks])
+        net_list = networks and ([{'net-id': self.lookup('network', n)} for n in networks])
         instance = nova_client.servers.create(
           name=name,
-          image=self._images[image],
-          flavor=self._flavors[flavor],
+          image=self.lookup('image', image),
+          flavor=self.lookup('flavor', flavor),
           nics=net_list,
           userdata=userdata_file,
           key_name=key_name,
@@ -134,43 +285,173 @@ class ApplyResources(object):
 
         return instance.id
 
-    def delete_servers(self, project_tag):
+    def lookup(self, kind, name):
+        """
+        The id of the image, flavor or network (kind) with the given name
+        or id, asking nova only the first time
+        """
+        key = '%s:%s' % (kind, name)
+        if key not in self._lookups:
+            self._lookups[key] = (self.resolve(kind, name), time.time())
+        return self._lookups[key][0]
+
+    def resolve(self, kind, name):
+        if kind == 'network':
+            # nova takes network ids as they are
+            try:
+                uuid.UUID(str(name))
+                return name
+            except ValueError:
+                pass
+        nova_client = self.get_nova_client()
+        manager = {'image': nova_client.images,
+                   'flavor': nova_client.flavors,
+                   'network': nova_client.networks}[kind]
+        return nova_utils.find_resource(manager, name).id
+
+    def resolve_all(self, servers, concurrency=1):
+        """
+        Look up every distinct image, flavor and network used by servers
+        in one go before any is created, and save the lookup cache
+        """
+        wanted = set()
+        for s in servers:
+            for kind in ('image', 'flavor'):
+                if s.get(kind):
+                    wanted.add((kind, s[kind]))
+            for network in s.get('networks') or []:
+                wanted.add(('network', network))
+        missing = sorted((kind, name) for kind, name in wanted
+                         if '%s:%s' % (kind, name) not in self._lookups)
+        if missing:
+            # set up the client before the threads need it
+            self.get_nova_client()
+        ids = run_pool(lambda item: self.resolve(*item), missing, concurrency)
+        now = time.time()
+        for (kind, name), id in zip(missing, ids):
+            self._lookups['%s:%s' % (kind, name)] = (id, now)
+        if self.lookup_cache_path and missing:
+            self.write_lookup_cache()
+
+    def lookup_cache_scope(self):
+        """
+        The cloud the ids in the lookup cache belong to
+        """
+        creds = get_nova_creds_from_env()
+        return dict((key, creds[key]) for key in ('auth_url', 'region_name', 'project_id'))
+
+    def read_lookup_cache(self):
+        try:
+            with open(self.lookup_cache_path) as fp:
+                cache = json.load(fp)
+            if cache['cloud'] != self.lookup_cache_scope():
+                return {}
+            lookups = cache['lookups']
+        except (IOError, ValueError, KeyError, TypeError):
+            return {}
+        oldest = time.time() - self.lookup_cache_ttl
+        return dict((key, tuple(entry)) for key, entry in lookups.iteritems()
+                    if entry[1] >= oldest)
+
+    def write_lookup_cache(self):
+        tmp_path = '%s.%d' % (self.lookup_cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump({'cloud': self.lookup_cache_scope(), 'lookups': self._lookups}, fp)
+            os.rename(tmp_path, self.lookup_cache_path)
+        except (IOError, OSError):
+            # The cache only saves lookups
+            pass
+
+    def delete_servers(self, project_tag, concurrency=1, wait=False, timeout=3600):
+        """
+        Delete the project's servers and release their floating IPs,
+        making up to concurrency calls to nova at once. The servers are
+        taken straight from the server list. If wait is true, return only
+        once nova no longer lists them (see wait_for_deletion). Prints how
+        long each step took.
+        """
         nova_client = self.get_nova_client()
-        servers = self.get_existing_servers(project_tag=project_tag, attr_name='id')
+        start = time.time()
+        servers = self.get_existing_servers(project_tag=project_tag, attr_name=None)
         ip_to_server_map = {ip.instance_id: ip for ip in nova_client.floating_ips.list()}
-        ips_to_delete = set()
-        for uuid in servers:
-            print "Deleting uuid: %s"%(uuid)
-            server = nova_client.servers.get(uuid)
-            if uuid in ip_to_server_map:
-                ip = ip_to_server_map[uuid]
+
+        def delete_server(server):
+            print "Deleting uuid: %s"%(server.id)
+            ip = ip_to_server_map.get(server.id)
+            if ip:
                 server.remove_floating_ip(ip.ip)
-                ips_to_delete.add(ip)
             server.delete()
+            return ip
 
-        for ip in ips_to_delete:
+        def delete_ip(ip):
             print "Deleting floating ip: %s" % (ip.ip,)
             ip.delete()
 
+        ips_to_delete = filter(None, run_pool(delete_server, servers, concurrency))
+        deleted = time.time()
+        run_pool(delete_ip, ips_to_delete, concurrency)
+        released = time.time()
+
+        print "Deleted %d servers in %.1fs" % (len(servers), deleted - start)
+        print "Released %d floating ips in %.1fs" % (len(ips_to_delete), released - deleted)
+        if wait:
+            self.wait_for_deletion([server.id for server in servers], project_tag, timeout)
+            print "Servers gone after %.1fs" % (time.time() - start,)
+
+    def wait_for_deletion(self, ids, project_tag=None, timeout=None):
+        """
+        Wait until nova no longer lists any of the servers with the given
+        ids, polling like wait_for_servers. Raises an exception listing
+        the servers left, with their status, if some are still there after
+        timeout seconds.
+        """
+        nova_client = self.get_nova_client()
+        search_opts = self.project_search_opts(project_tag)
+        pending = set(ids)
+        remaining = {}
+        delay = self.POLL_MIN
+        deadline = timeout and time.time() + timeout
+        while pending:
+            if deadline and time.time() >= deadline:
+                raise Exception('Servers not deleted: %s' % ', '.join(
+                    '%s (%s): %s' % (remaining[i].name, i, remaining[i].status)
+                    for i in sorted(pending)))
+            time.sleep(delay)
+            remaining = dict((server.id, server) for server in
+                             nova_client.servers.list(detailed=True, search_opts=search_opts))
+            gone = pending.difference(remaining)
+            pending.difference_update(gone)
+            delay = gone and self.POLL_MIN or min(delay * 2, self.POLL_MAX)
+
     def ssh_config(self, servers):
-        out = ''
+        return ''.join(self.iter_ssh_config(servers))
+
+    def iter_ssh_config(self, servers):
+        """
+        Generate the ssh config for servers a host entry at a time. The
+        addresses of all of them are looked up with one server list, and
+        if any of them is missing nothing is generated.
+        """
+        ips = utils.get_ip_index(self.get_nova_client())
+        missing = [s['name'] for s in servers if s['name'] not in ips]
+        if missing:
+            raise Exception('Server not found: %s' % ', '.join(missing))
+
         bastions = filter(lambda s:s.get('assign_floating_ip', False), servers)
         if bastions:
-            bastion = utils.get_ip_of_node(self.get_nova_client(), bastions[0]['name'])
+            bastion = ips[bastions[0]['name']]
         else:
             bastion = None
 
-        out += 'StrictHostKeyChecking no\n'
-        out += 'UserKnownHostsFile /dev/null\n'
-        out += '\n'
+        yield 'StrictHostKeyChecking no\nUserKnownHostsFile /dev/null\n\n'
         for s in servers:
-            out += 'Host %s\n' % (s['name'],)
-            ip = utils.get_ip_of_node(apply_resources.get_nova_client(),  s['name'])
-            out += '    HostName %s\n' % (ip,)
+            out = 'Host %s\n' % (s['name'],)
+            out += '    HostName %s\n' % (ips[s['name']],)
             if not s.get('assign_floating_ip', False) and bastion:
                 out += '    ProxyCommand ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null %%r@%s nc %%h %%p\n' % (bastion,)
             out += '\n'
-        return out
+            yield out
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
@@ -183,9 +464,20 @@ if __name__ == '__main__':
     apply_parser.add_argument('--project_tag', help='Project tag')
     apply_parser.add_argument('--key_name', help='Name of key pair')
     apply_parser.add_argument('--override_instance_number', help='Override number of instances of a type. Values is e.g. "cp=5:ct=2" to start 5 cp nodes, 2 ct nodes and go with defaults for the rest')
+    apply_parser.add_argument('--concurrency', type=int, default=1, help='Number of servers to create at once')
+    apply_parser.add_argument('--rate-limit', type=float, help='Maximum number of create requests per second')
+    apply_parser.add_argument('--timeout', type=int, default=3600,
+                              help='Seconds to wait for the servers to build')
+    apply_parser.add_argument('--lookup-cache', help='File to keep image, flavor and network ids in between runs')
+    apply_parser.add_argument('--lookup-cache-ttl', type=int, default=3600,
+                              help='Seconds to trust ids from the lookup cache (default: 3600)')
 
     delete_parser = subparsers.add_parser('delete', help='Delete a project')
     delete_parser.add_argument('project_tag', help='Id of project to delete')
+    delete_parser.add_argument('--concurrency', type=int, default=1, help='Number of servers to delete at once')
+    delete_parser.add_argument('--wait', action='store_true', help='Wait until the servers are gone')
+    delete_parser.add_argument('--timeout', type=int, default=3600,
+                               help='Seconds to wait for the servers to go with --wait')
 
     list_parser  = subparsers.add_parser('list', help='List servers described in resource file')
     list_parser.add_argument('resource_file_path', help='Path to resource file')
@@ -198,7 +490,7 @@ if __name__ == '__main__':
 
     args = argparser.parse_args()
     if args.action == 'apply':
-        apply_resources = ApplyResources()
+        apply_resources = ApplyResources(args.lookup_cache, args.lookup_cache_ttl)
         if args.override_instance_number:
             number_overrides = {a:int(b) for (a, b) in [x.split('=') for x in args.override_instance_number.split(':')]}
         else:
@@ -207,11 +499,15 @@ if __name__ == '__main__':
                                                     args.mappings,
                                                     project_tag=args.project_tag,
                                                     number_overrides=number_overrides)
-        apply_resources.create_servers(servers, args.userdata, key_name=args.key_name)
+        apply_resources.create_servers(servers, args.userdata, key_name=args.key_name,
+                                       concurrency=args.concurrency, rate_limit=args.rate_limit,
+                                       project_tag=args.project_tag, timeout=args.timeout)
     elif args.action == 'delete':
         if not args.project_tag:
             argparser.error("Must set project tag when action is delete")
-        ApplyResources().delete_servers(project_tag=args.project_tag)
+        ApplyResources().delete_servers(project_tag=args.project_tag,
+                                        concurrency=args.concurrency, wait=args.wait,
+                                        timeout=args.timeout)
     elif args.action == 'list':
         apply_resources = ApplyResources()
         resources = apply_resources.read_resources(args.resource_file_path)
@@ -222,4 +518,6 @@ if __name__ == '__main__':
         resources = apply_resources.read_resources(args.resource_file_path)
         mappings = args.mappings and apply_resources.read_mappings(args.mappings) or {}
         servers = apply_resources.generate_desired_servers(resources, mappings, args.project_tag)
-        print apply_resources.ssh_config(servers)
+        for chunk in apply_resources.iter_ssh_config(servers):
+            sys.stdout.write(chunk)
+        print
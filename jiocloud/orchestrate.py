@@ -14,20 +14,313 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 #
+#
+# jorc runs hundreds of times an hour on every node, so only cheap modules
+# are imported up front. Everything else (consulate and the HTTP stack in
+# particular) is imported where it is used.
+#
 import argparse
+import contextlib
 import errno
 import sys
 import socket
+import StringIO
 import time
-import urllib3
-import urlparse
 import os
-import netifaces
-import re
-import json
-import yaml
-import consulate
-from urllib3.exceptions import HTTPError
+
+def concurrently(*calls):
+    """
+    Run calls (functions taking no arguments) in parallel threads and
+    return their results in order. If any of them raised, the first such
+    exception is re-raised once all of them are done.
+    """
+    import threading
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except Exception:
+            errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(1, len(calls))]
+    for thread in threads:
+        thread.start()
+    if calls:
+        run(0)
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+    return results
+
+
+class ConsulMetrics(object):
+    """
+    Request counts, errors, bytes received and latency histograms of the
+    consul calls made for a jorc subcommand, per endpoint
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    # metric family: (type, help)
+    FAMILIES = [('jorc_consul_requests_total', 'counter',
+                 'Consul API calls made by jorc'),
+                ('jorc_consul_request_errors_total', 'counter',
+                 'Consul API calls made by jorc that failed'),
+                ('jorc_consul_response_bytes_total', 'counter',
+                 'Bytes received from the consul API by jorc'),
+                ('jorc_consul_request_duration_seconds', 'histogram',
+                 'Latency of consul API calls made by jorc')]
+
+    def __init__(self, subcommand=None):
+        import threading
+        self.subcommand = subcommand
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_name(method, path):
+        """
+        A low cardinality name for a request: only the first two path
+        components are kept, so e.g. keys are cut down to their first
+        component and node names are dropped
+        """
+        return '%s %s' % (method, '/'.join(path.strip('/').split('/')[:2]))
+
+    def record(self, endpoint, seconds, nbytes=0, error=False):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'count': 0, 'errors': 0, 'bytes': 0,
+                                                    'seconds': 0.0, 'max': 0.0,
+                                                    'buckets': [0] * len(self.BUCKETS)}
+            stats['count'] += 1
+            stats['errors'] += error and 1 or 0
+            stats['bytes'] += nbytes
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def summary(self):
+        lines = ['Consul calls for %s:' % (self.subcommand,)]
+        for endpoint, stats in sorted(self.endpoints.iteritems()):
+            lines.append('  %s: %d calls, %d errors, %d bytes, %.1fms total, %.1fms max' %
+                         (endpoint, stats['count'], stats['errors'], stats['bytes'],
+                          stats['seconds'] * 1000, stats['max'] * 1000))
+        if not self.endpoints:
+            lines.append('  none')
+        return '\n'.join(lines) + '\n'
+
+    def samples(self):
+        """
+        Generate ((metric name, label string), value) pairs in the
+        prometheus text format
+        """
+        def quote(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        for endpoint, stats in sorted(self.endpoints.iteritems()):
+            labels = 'subcommand="%s",endpoint="%s"' % (quote(self.subcommand), quote(endpoint))
+            yield ('jorc_consul_requests_total', '{%s}' % labels), stats['count']
+            yield ('jorc_consul_request_errors_total', '{%s}' % labels), stats['errors']
+            yield ('jorc_consul_response_bytes_total', '{%s}' % labels), stats['bytes']
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, stats['buckets']):
+                cumulative += count
+                yield (('jorc_consul_request_duration_seconds_bucket',
+                        '{%s,le="%s"}' % (labels, bound)), cumulative)
+            yield (('jorc_consul_request_duration_seconds_bucket',
+                    '{%s,le="+Inf"}' % (labels,)), stats['count'])
+            yield ('jorc_consul_request_duration_seconds_sum', '{%s}' % labels), stats['seconds']
+            yield ('jorc_consul_request_duration_seconds_count', '{%s}' % labels), stats['count']
+
+    def write_textfile(self, path):
+        """
+        Add these metrics to the totals kept in a node_exporter textfile
+        collector file. The file is replaced atomically, and concurrent
+        jorc processes are serialised with a lock file next to it.
+        """
+        import fcntl
+        import re
+        sample_re = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+        le_re = re.compile(r',?le="([^"]*)"')
+
+        def order(sample):
+            # The text format wants each series' buckets by increasing le,
+            # +Inf last, followed by its _sum and _count
+            (name, labels), value = sample
+            le = le_re.search(labels)
+            suffix = name.rsplit('_', 1)[-1]
+            return (le_re.sub('', labels), {'sum': 1, 'count': 2}.get(suffix, 0),
+                    le and float(le.group(1)) or 0, name)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = {}
+            try:
+                with open(path) as fp:
+                    for line in fp:
+                        match = sample_re.match(line.strip())
+                        if match:
+                            totals[(match.group(1), match.group(2) or '')] = float(match.group(3))
+            except IOError:
+                pass
+            for key, value in self.samples():
+                totals[key] = totals.get(key, 0) + value
+
+            tmp_path = '%s.%d' % (path, os.getpid())
+            with open(tmp_path, 'w') as fp:
+                for family, metric_type, help_text in self.FAMILIES:
+                    fp.write('# HELP %s %s\n' % (family, help_text))
+                    fp.write('# TYPE %s %s\n' % (family, metric_type))
+                    for (name, labels), value in sorted(totals.iteritems(), key=order):
+                        if name == family or (metric_type == 'histogram' and
+                                              name in (family + '_bucket', family + '_sum',
+                                                       family + '_count')):
+                            fp.write('%s%s %s\n' % (name, labels,
+                                                     value == int(value) and '%d' % value or repr(value)))
+            os.rename(tmp_path, path)
+
+
+class InstrumentedProxy(object):
+    """
+    Wraps a consulate client, recording each API call made through it in
+    a ConsulMetrics
+    """
+    def __init__(self, target, metrics, name=''):
+        self._target = target
+        self._metrics = metrics
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if isinstance(value, (basestring, int, long, float, bool, type(None),
+                              dict, list, tuple)):
+            return value
+        return InstrumentedProxy(value, self._metrics,
+                                 self._name and '%s.%s' % (self._name, attr) or attr)
+
+    def __call__(self, *args, **kwargs):
+        start = time.time()
+        error = True
+        try:
+            result = self._target(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            self._metrics.record('consulate %s' % (self._name,), time.time() - start,
+                                 error=error)
+
+
+class HealthSummary(object):
+    """
+    Classification of a snapshot of consul health checks, made in a single
+    pass. Checks are sorted into failures and other warnings, and counted
+    per status, per node and per check name.
+    """
+    # validation and puppet failures are being treated as warnings in consul
+    # that when they fail during bootstrapping, it does not cause services
+    # to be deregistered by consul. These "warnings" are treated as
+    # failures here.
+    FAILING_WARNINGS = ('puppet', 'validation')
+
+    def __init__(self, checks):
+        self.failures = []
+        self.warnings = []
+        self.by_status = {}
+        self.by_node = {}
+        self.by_check = {}
+        for check in checks:
+            status = check['Status']
+            if self.is_failure(check):
+                self.failures.append(check)
+            elif status == 'warning':
+                self.warnings.append(check)
+            self.by_status[status] = self.by_status.get(status, 0) + 1
+            for counters, key in ((self.by_node, check['Node']),
+                                  (self.by_check, check['Name'])):
+                counts = counters.setdefault(key, {})
+                counts[status] = counts.get(status, 0) + 1
+
+    @classmethod
+    def is_failure(cls, check):
+        return check['Status'] == 'critical' or (check['Status'] == 'warning' and
+                                                 check['Name'] in cls.FAILING_WARNINGS)
+
+    @classmethod
+    def merge(cls, summaries):
+        """
+        Combine the summaries of several snapshots (e.g. one per
+        datacenter) into one
+        """
+        merged = cls([])
+        for summary in summaries:
+            merged.failures.extend(summary.failures)
+            merged.warnings.extend(summary.warnings)
+            for status, count in summary.by_status.iteritems():
+                merged.by_status[status] = merged.by_status.get(status, 0) + count
+            for counters, other in ((merged.by_node, summary.by_node),
+                                    (merged.by_check, summary.by_check)):
+                for key, counts in other.iteritems():
+                    mine = counters.setdefault(key, {})
+                    for status, count in counts.iteritems():
+                        mine[status] = mine.get(status, 0) + count
+        return merged
+
+    def failing_nodes(self):
+        return set(x['Node'] for x in self.failures)
+
+    def healthy(self, show_warnings=False):
+        return not self.failures and not (show_warnings and self.warnings)
+
+    def as_dict(self, show_warnings=False):
+        def brief(checks):
+            return [{'node': x['Node'], 'check': x['Name'],
+                     'status': x['Status'], 'output': x.get('Output', '')}
+                    for x in checks]
+        return {'healthy': self.healthy(show_warnings),
+                'failures': brief(self.failures),
+                'warnings': brief(self.warnings),
+                'counts': {'status': self.by_status,
+                           'node': self.by_node,
+                           'check': self.by_check}}
+
+
+class ConvergenceView(object):
+    """
+    Progress of a set of hosts towards running a version with no failing
+    checks, updated from each census and health summary as they come in.
+    """
+    def __init__(self, version, hosts):
+        self.version = version
+        self.expected = set(hosts)
+        self.at_version = set()
+        self.failing = set()
+
+    def update(self, census, summary):
+        self.at_version = census.get(self.version, set()) & self.expected
+        self.failing = summary.failing_nodes() & self.expected
+
+    def converged(self):
+        return self.at_version == self.expected and not self.failing
+
+    def lagging(self):
+        """
+        The hosts holding up convergence: those not at version yet along
+        with those that have failing checks
+        """
+        return sorted((self.expected - self.at_version) | self.failing)
+
+    def __str__(self):
+        return '%d/%d hosts at %s, %d failing' % (len(self.at_version),
+                                                   len(self.expected),
+                                                   self.version,
+                                                   len(self.failing))
+
 
 class DeploymentOrchestrator(object):
     UPDATE_AVAILABLE = 0
@@ -35,142 +328,947 @@ class DeploymentOrchestrator(object):
     NO_CLUE = 2
     NO_CLUE_BUT_WERE_JUST_GETTING_STARTED = 3
 
-    def __init__(self, host='127.0.0.1', port=8500):
+    # consul refuses transactions with more operations than this
+    TXN_MAX_OPS = 64
+
+    # Upper bound on requests in flight at once from one orchestrator
+    MAX_CONCURRENCY = 8
+
+    # Flag set on /current_version while jorc rollout is moving hosts to a
+    # new version. Hosts then check /target_version/<host> for their own
+    # target before falling back to the value of /current_version.
+    ROLLOUT_FLAG = 1
+
+    CONSISTENCY_MODES = ('stale', 'default', 'consistent')
+
+    # How far behind the cached index a stale read may be and still be
+    # taken for a lagging server. A bigger step back means consul's state
+    # was reset, e.g. by a rebuild or a snapshot restore.
+    LAGGING_INDEX_GAP = 1000
+
+    # Name of the consul user event trigger_update can fire. Its payload
+    # is the new version.
+    UPDATE_EVENT = 'jorc-update'
+
+    def __init__(self, host='127.0.0.1', port=8500, cache_path=None,
+                 cache_ttl=0, max_stale=None, consistency='default',
+                 datacenter=None):
+        """
+        consistency is the consul consistency mode used for all reads.
+        'stale' lets any server answer, which takes load off the leader
+        at the price of possibly slightly outdated results.
+
+        datacenter is the consul datacenter to query through the agent,
+        which by default is the agent's own.
+
+        If cache_path is given, the last known /current_version is kept
+        there. It is served without asking consul for cache_ttl seconds
+        after it was last confirmed, and, if consul can not be reached,
+        for up to max_stale seconds (None meaning forever).
+        """
         self.host = host
         self.port = port
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.max_stale = max_stale
+        if consistency not in self.CONSISTENCY_MODES:
+            raise ValueError('Invalid consistency mode: %s' % consistency)
+        self.consistency = consistency
+        self.datacenter = datacenter
+        # set by jorc serve to take over update_own_status
+        self.status_reporter = None
+        # url -> (status, index, body) of the reads made in the current
+        # snapshot, if any
+        self._snapshot = None
         self._consul = None
         self._kv = None
+        self._http = None
+        self.metrics = ConsulMetrics()
 
     @property
     def consul(self):
         if not self._consul:
+            import consulate
             self._consul = session = consulate.Consulate(self.host, self.port)
-        return self._consul
+        return InstrumentedProxy(self._consul, self.metrics)
+
+    @property
+    def http(self):
+        if not self._http:
+            import urllib3
+            # Several requests may be in flight at once (see concurrently
+            # and watch_fleet)
+            self._http = urllib3.HTTPConnectionPool(self.host, self.port,
+                                                    maxsize=self.MAX_CONCURRENCY)
+        return self._http
+
+    def _request(self, method, path, params=None, body=None, timeout=None,
+                 index=None, wait=None):
+        """
+        Make a raw request against the consul HTTP API. Used for the parts
+        of the API consulate does not expose (blocking queries etc.)
+
+        Returns a (status, index, data) tuple, where index is the value of
+        the X-Consul-Index header (or None) and data is the decoded JSON
+        body (or None if there was no body). Parameters with a value of
+        None are passed as bare flags (e.g. ?recurse). Reads use the
+        configured consistency mode and all requests go to the configured
+        datacenter.
+
+        If index is given, this is a blocking query that returns once the
+        result's index moves past it or wait seconds pass.
+
+        Within a snapshot (see below) other reads are answered from the
+        snapshot after the first time.
+        """
+        import json
+        import urllib
+        url = '/v1/%s' % path.lstrip('/')
+        if index is not None:
+            params = dict(params or {}, index=index, wait='%ds' % wait)
+            # consul adds up to wait/16 of jitter
+            timeout = wait + wait / 16 + 5
+        if method == 'GET' and self.consistency != 'default':
+            params = dict(params or {})
+            params[self.consistency] = None
+        if self.datacenter:
+            params = dict(params or {}, dc=self.datacenter)
+        if params:
+            url += '?' + '&'.join(v is None and urllib.quote(k) or
+                                  urllib.urlencode({k: v})
+                                  for k, v in sorted(params.items()))
+        snapshot = self._snapshot
+        if snapshot is not None and method != 'GET':
+            snapshot.clear()
+        cacheable = snapshot is not None and method == 'GET' and index is None
+        if cacheable and url in snapshot:
+            status, index, body = snapshot[url]
+        else:
+            status, index, body = self._send(method, url, path, body, timeout)
+            if cacheable:
+                snapshot[url] = status, index, body
+        data = None
+        if body:
+            data = json.loads(body)
+        return status, index, data
+
+    def _send(self, method, url, path, body, timeout):
+        from urllib3.exceptions import HTTPError
+        endpoint = self.metrics.endpoint_name(method, path)
+        start = time.time()
+        try:
+            res = self.http.urlopen(method, url, body=body, timeout=timeout,
+                                    retries=False)
+        except Exception:
+            self.metrics.record(endpoint, time.time() - start, error=True)
+            raise
+        self.metrics.record(endpoint, time.time() - start, len(res.data or ''),
+                            error=res.status >= 400 and res.status != 404)
+        if res.status >= 500 or res.status in (400, 403):
+            raise HTTPError('%s %s: %s %s' % (method, url, res.status, res.data))
+        index = res.getheader('X-Consul-Index')
+        return res.status, index and int(index), res.data
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Share one view of consul between everything done in the block:
+        each KV, health or catalog read is sent at most once and later
+        reads of the same thing get the same answer. Any write through
+        _request drops the snapshot taken so far. Blocking queries always
+        go to consul. Snapshots do not nest; an inner one just joins the
+        outer one.
+        """
+        if self._snapshot is not None:
+            yield
+            return
+        self._snapshot = {}
+        try:
+            yield
+        finally:
+            self._snapshot = None
+
+    def datacenters(self):
+        """
+        The names of all known consul datacenters
+        """
+        status, _, data = self._request('GET', 'catalog/datacenters')
+        return data or []
+
+    def in_datacenter(self, datacenter):
+        """
+        A copy of this orchestrator that queries datacenter instead,
+        sharing its connections and metrics
+        """
+        import copy
+        # set up the connection pool first, so the copy shares it
+        self.http
+        other = copy.copy(self)
+        other.datacenter = datacenter
+        return other
+
+    def across_datacenters(self, datacenters, fetch):
+        """
+        Call fetch with an orchestrator for each of datacenters, all at
+        once, so the whole takes as long as the slowest datacenter.
+        Returns a dict mapping each datacenter to what fetch returned.
+        """
+        results = concurrently(*[lambda dc=dc: fetch(self.in_datacenter(dc))
+                                 for dc in datacenters])
+        return dict(zip(datacenters, results))
+
+    @staticmethod
+    def _next_index(old, new):
+        """
+        The index to pass to the next blocking query, given the previous
+        one and the one just returned
+        """
+        # an index going backwards means consul's state was reset
+        if new is None or (old is not None and new < old):
+            return 0
+        return new
+
+    def _kv_get(self, key, index=None, wait=None):
+        """
+        Read a single key, optionally as a blocking query.
 
-    def trigger_update(self, new_version):
-        self.consul.kv.set('/current_version', new_version)
+        Returns a (entry, index) tuple, entry being the KV record with its
+        Value base64 decoded, or None if the key does not exist.
+        """
+        import base64
+        status, index, data = self._request('GET', 'kv/%s' % key.lstrip('/'),
+                                            index=index, wait=wait)
+        if status == 404 or not data:
+            return None, index
+        entry = data[0]
+        if entry.get('Value') is not None:
+            entry['Value'] = base64.b64decode(entry['Value'])
+        return entry, index
 
-    def local_health(self, hostname=socket.gethostname(), verbose=False):
-        results = self.consul.health.node(hostname)
-        failing = [x for x in results if (x['Status'] == 'critical'
-                                          or (x['Status'] == 'warning' and (x['Name'] == 'puppet' or x['Name'] == 'validation'))) ]
+    def _kv_keys(self, prefix):
+        """
+        List the keys under prefix without fetching their values
+        """
+        status, _, data = self._request('GET', 'kv/%s' % prefix.lstrip('/'),
+                                        {'keys': None})
+        if status == 404:
+            return []
+        return data or []
+
+    def _kv_find(self, prefix, indexes=False):
+        """
+        Fetch every key under prefix along with its (decoded) value, or
+        with indexes, a (value, ModifyIndex) pair for use with check-and-set
+        operations
+        """
+        import base64
+        status, _, data = self._request('GET', 'kv/%s' % prefix.lstrip('/'),
+                                        {'recurse': None})
+        if status == 404:
+            return {}
+        found = {}
+        for x in data or []:
+            value = x['Value'] and base64.b64decode(x['Value'])
+            found[x['Key']] = indexes and (value, x['ModifyIndex']) or value
+        return found
+
+    def _kv_op(self, verb, key, value=None, flags=None, index=None):
+        import base64
+        op = {'Verb': verb, 'Key': key.lstrip('/')}
+        if value is not None:
+            op['Value'] = base64.b64encode(value)
+        if flags is not None:
+            op['Flags'] = flags
+        if index is not None:
+            op['Index'] = index
+        return {'KV': op}
+
+    def _txn(self, ops, ordered=True):
+        """
+        Apply a list of KV operations (see _kv_op) through the transaction
+        API. Lists longer than TXN_MAX_OPS are split into several
+        transactions, each of which is applied atomically. Unless ordered
+        is true, up to MAX_CONCURRENCY of those are sent at once.
+        """
+        import json
+        from urllib3.exceptions import HTTPError
+
+        def apply(batch):
+            status, _, data = self._request('PUT', 'txn', body=json.dumps(batch))
+            if status != 200:
+                raise HTTPError('Transaction failed: %r' % ((data or {}).get('Errors'),))
+
+        batches = [ops[i:i + self.TXN_MAX_OPS] for i in range(0, len(ops), self.TXN_MAX_OPS)]
+        if ordered:
+            for batch in batches:
+                apply(batch)
+            return
+        for i in range(0, len(batches), self.MAX_CONCURRENCY):
+            concurrently(*[lambda batch=batch: apply(batch)
+                           for batch in batches[i:i + self.MAX_CONCURRENCY]])
+
+    def watch_update(self, hook=None, wait=300, hostname=None):
+        """
+        Wait for the version hostname should run (see current_version) to
+        differ from the local version.
+
+        This uses consul blocking queries, so while the version is unchanged
+        there is a single request held open by consul for up to wait
+        seconds. Without a hook, the new version is returned as soon as it
+        is seen. With a hook, the hook is run with the new version as its
+        last argument and we keep watching. If the hook fails, it is run
+        again on the next read unless the local version has changed.
+        """
+        import shlex
+        import subprocess
+        from urllib3.exceptions import HTTPError
+        seen = self.local_version()
+        index = None
+        backoff = 1
+        while True:
+            try:
+                entry, new_index = self._kv_get('/current_version', index, wait)
+            except (IOError, HTTPError):
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                index = None
+                continue
+            backoff = 1
+            index = self._next_index(index, new_index)
+            version = self._target_version(entry, hostname)
+            if not version or version == seen:
+                continue
+            if not hook:
+                return version
+            if subprocess.call(shlex.split(hook) + [version]) == 0:
+                seen = version
+            else:
+                seen = self.local_version()
+
+    def trigger_update(self, new_version, event=False):
+        """
+        Set the version every host should run. If event is true, also
+        tell all hosts about it right away with a consul user event,
+        which spreads by gossip rather than through the servers (see
+        handle_update_events).
+
+        This also cancels any rollout: the per-host targets are removed
+        along with the rollout flag.
+        """
+        self._txn([self._kv_op('set', 'current_version', new_version),
+                   self._kv_op('delete-tree', 'target_version/')])
+        if event:
+            self._request('PUT', 'event/fire/%s' % self.UPDATE_EVENT, body=new_version)
+
+    def handle_update_events(self, events, hook=None, state_path=None):
+        """
+        Act on the UPDATE_EVENT events in events, the list a consul event
+        watch passes to its handler. The watch hands over every event it
+        still buffers each time, so only the newest (by Lamport time) is
+        looked at, and if state_path is given, the Lamport time of the
+        last event acted on is kept there so it is not acted on twice.
+
+        If the event's version differs from the local version, hook is run
+        with the version as its last argument. No KV reads are needed, as
+        the version is the event's payload. If the hook fails, the event
+        is not recorded as acted on, so the next delivery tries again.
+
+        Returns the version acted on (or None) and the hook's exit status.
+        """
+        import base64
+        import shlex
+        import subprocess
+        events = [e for e in events if e.get('Name') == self.UPDATE_EVENT]
+        if not events:
+            return None, 0
+        event = max(events, key=lambda e: e.get('LTime', 0))
+        last = None
+        if state_path:
+            try:
+                with open(state_path) as fp:
+                    last = int(fp.read())
+            except (IOError, ValueError):
+                pass
+        if last is not None and event.get('LTime', 0) <= last:
+            return None, 0
+        version = base64.b64decode(event.get('Payload') or '')
+        status = 0
+        if not version or version == self.local_version():
+            version = None
+        elif hook:
+            status = subprocess.call(shlex.split(hook) + [version])
+        if state_path and status == 0:
+            tmp_path = '%s.%d' % (state_path, os.getpid())
+            with open(tmp_path, 'w') as fp:
+                fp.write(str(event.get('LTime', 0)))
+            os.rename(tmp_path, state_path)
+        return version, status
+
+    def local_health(self, hostname=None, verbose=False, server=False):
+        """
+        The failing checks of this host, as the local agent sees them. If
+        server is true, ask the consul servers about hostname instead.
+        """
+        checks, _ = self._node_checks(hostname, server)
+        failing = filter(HealthSummary.is_failure, checks)
         if verbose:
             for x in failing:
                 print '%s: %s' % (x['Name'], x['Output'])
         return failing
 
-    def pending_update(self):
-        local_version = self.local_version()
-        try:
-            if (self.current_version() == local_version):
-                return self.UP_TO_DATE
-            elif (self.current_version() == None):
-                return self.NO_CLUE_BUT_WERE_JUST_GETTING_STARTED
+    def _node_checks(self, hostname=None, server=False, index=None, wait=None):
+        """
+        The checks of a node along with the consul index they reflect.
+        The agent answers for itself without involving the servers, but
+        can not hold the request open, so only the server query blocks.
+        """
+        if not server:
+            status, index, checks = self._request('GET', 'agent/checks')
+            return sorted((checks or {}).values(), key=lambda x: x['CheckID']), index
+        hostname = hostname or socket.gethostname()
+        status, index, checks = self._request('GET', 'health/node/%s' % hostname,
+                                              index=index, wait=wait)
+        return checks or [], index
+
+    def watch_local_health(self, hostname=None, server=False, wait=60, interval=5):
+        """
+        Yield the failing checks of this host (see local_health) at first
+        and then each time they change. The agent is polled every interval
+        seconds, which stays on this host. If server is true, blocking
+        queries against the servers are used instead.
+        """
+        from urllib3.exceptions import HTTPError
+        last = None
+        index = None
+        backoff = 1
+        while True:
+            try:
+                checks, new_index = self._node_checks(hostname, server, index, wait)
+            except (IOError, HTTPError):
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                index = None
+                continue
+            backoff = 1
+            failing = filter(HealthSummary.is_failure, checks)
+            state = sorted((x['Name'], x['Status']) for x in failing)
+            if state != last:
+                yield failing
+                last = state
+            if server:
+                index = self._next_index(index, new_index)
             else:
-                return self.UPDATE_AVAILABLE
-        except:
+                time.sleep(interval)
+
+    def pending_update(self, hostname=None):
+        no_clue = object()
+
+        def fetch_current_version():
+            try:
+                return self.current_version(hostname)
+            except:
+                return no_clue
+
+        local_version, current_version = concurrently(self.local_version,
+                                                      fetch_current_version)
+        if current_version is no_clue:
             if local_version:
                 return self.NO_CLUE
             else:
                 return self.NO_CLUE_BUT_WERE_JUST_GETTING_STARTED
+        elif (current_version == local_version):
+            return self.UP_TO_DATE
+        elif (current_version == None):
+            return self.NO_CLUE_BUT_WERE_JUST_GETTING_STARTED
+        else:
+            return self.UPDATE_AVAILABLE
+
+    def current_version(self, hostname=None):
+        """
+        The version to deploy. Given a hostname, this is the version that
+        particular host should run, which differs from /current_version
+        while a rollout is in progress.
+
+        The cache holds the /current_version entry itself, so while a
+        rollout is flagged the host's target is still looked up.
+        """
+        cache = self.cache_path and self._read_version_cache()
+        if cache and time.time() - cache['checked'] < self.cache_ttl:
+            return self._target_version(cache['entry'], hostname)
+        try:
+            entry, index = self._kv_get('/current_version')
+        except Exception:
+            if cache and (self.max_stale is None or
+                          time.time() - cache['checked'] <= self.max_stale):
+                return self._target_version(cache['entry'], hostname)
+            raise
+        if self.cache_path:
+            if (cache and index is not None and self.consistency == 'stale' and
+                    cache['index'] - self.LAGGING_INDEX_GAP < index < cache['index']):
+                # A lagging server answered with something older than what
+                # we already know. Keep what we have. Other reads go to the
+                # leader, which never lags.
+                entry = cache['entry']
+                index = cache['index']
+            self._write_version_cache(entry, index)
+        return self._target_version(entry, hostname)
 
-    def current_version(self):
-        cur_ver = self.consul.kv.get('/current_version')
-        if cur_ver == None:
+    def _target_version(self, entry, hostname):
+        """
+        The version hostname should run, given the /current_version entry
+        """
+        if entry is None:
             return None
-        else:
-            return str(cur_ver).strip()
+        version = (entry['Value'] or '').strip()
+        if hostname and entry.get('Flags', 0) & self.ROLLOUT_FLAG:
+            target, _ = self._kv_get('/target_version/%s' % hostname)
+            if target is not None:
+                version = (target['Value'] or '').strip()
+        return version
+
+    def _read_version_cache(self):
+        import json
+        try:
+            with open(self.cache_path) as fp:
+                cache = json.load(fp)
+            cache['index'] = cache['index'] or 0
+            if 'entry' not in cache:
+                # Written by an older jorc, which cached the answer itself
+                return None
+            return cache
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write_version_cache(self, entry, index):
+        import json
+        if entry is not None:
+            entry = {'Value': entry['Value'], 'Flags': entry.get('Flags', 0)}
+        tmp_path = '%s.%d' % (self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump({'entry': entry, 'index': index, 'checked': time.time()}, fp)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            # The cache is only an optimisation
+            pass
 
     def ping(self):
+        from urllib3.exceptions import HTTPError
         try:
             return bool(self.consul.agent.members())
         except (IOError, HTTPError):
             return False
 
-    def update_own_status(self, hostname, status_type, status_result):
-        status_dir = '/status/%s' % status_type
+    def own_status(self, status_type, status_result):
+        """
+        The state ('pass' or 'warn') of the status_type TTL check, given
+        the exit code of the puppet run or validation script
+        """
         if status_type == 'puppet':
-            if int(status_result) in (4, 6, 1):
-                self.consul.agent.check.ttl_warn('puppet')
-            elif int(status_result) == -1:
-                self.consul.agent.check.ttl_warn('puppet')
-            else:
-                self.consul.agent.check.ttl_pass('puppet')
+            if int(status_result) in (4, 6, 1, -1):
+                return 'warn'
+            return 'pass'
         elif status_type == 'validation':
             if int(status_result) == 0:
-                self.consul.agent.check.ttl_pass('validation')
-            else:
-                self.consul.agent.check.ttl_warn('validation')
+                return 'pass'
+            return 'warn'
         else:
             raise Exception('Invalid status_type:%s' % status_type)
 
-    # this is not removing outdated versions?
+    def update_own_status(self, hostname, status_type, status_result):
+        self.check_ttl(status_type, self.own_status(status_type, status_result))
+
+    def check_ttl(self, check_id, state):
+        """
+        Put the local agent's TTL check check_id in state ('pass', 'warn'
+        or 'fail'), resetting its TTL
+        """
+        self._request('PUT', 'agent/check/%s/%s' % (state, check_id))
+
     def update_own_info(self, hostname, version=None):
+        """
+        Register hostname as running version and drop its registration
+        under the version it ran before, as recorded in the
+        /host_version/<host> index. This is two small requests, no matter
+        how many versions or hosts there are.
+        """
         version = version or self.local_version()
         if not version:
             return
-        version_dir = '/running_version/%s' % version
-        self.consul.kv.set('%s/%s' % (version_dir, hostname), str(time.time()))
-        versions = self.running_versions()
-        versions.discard(version)
-        # check if other versions are registered for the same host
-        for v in versions:
-            if hostname in self.hosts_at_version(v):
-                self.consul.kv.__delitem__('%s/%s/%s' % ('running_version', v, hostname))
-
-    # this call may not scale
-    # if pulls down all host version records as
-    # a single hash
-    def running_versions(self):
+        ops = [self._kv_op('set', 'running_version/%s/%s' % (version, hostname),
+                           str(time.time())),
+               self._kv_op('set', 'host_version/%s' % hostname, version)]
+        previous = self.host_version(hostname)
+        if previous is None:
+            # Not in the index yet, so look for stale registrations the
+            # slow way. See backfill_host_versions.
+            for v, hosts in sorted(self.version_census().iteritems()):
+                if v != version and hostname in hosts:
+                    ops.append(self._kv_op('delete', 'running_version/%s/%s' % (v, hostname)))
+        elif previous != version:
+            ops.append(self._kv_op('delete', 'running_version/%s/%s' % (previous, hostname)))
+        self._txn(ops)
+
+    def host_version(self, hostname):
+        """
+        Look up the version hostname last registered, or None if unknown
+        """
+        entry, _ = self._kv_get('/host_version/%s' % hostname)
+        return entry and entry['Value']
+
+    def backfill_host_versions(self, dry_run=False):
+        """
+        Build the /host_version index from the /running_version tree, for
+        hosts that registered before the index existed. Where a host is
+        registered under several versions, the most recent registration
+        wins.
+
+        Returns a dict mapping each host to its version.
+        """
+        latest = self._latest_registrations(self._registrations())
+        index = dict((host, r[1]) for host, r in latest.iteritems())
+        if not dry_run:
+            self._txn([self._kv_op('set', 'host_version/%s' % host, version)
+                       for host, version in sorted(index.iteritems())], ordered=False)
+        return index
+
+    def _registrations(self, values=None):
+        """
+        Parse the /running_version tree (as returned by _kv_find) into a
+        list of (key, version, host, timestamp) tuples. Registrations with
+        a missing or garbled timestamp get timestamp 0.
+        """
+        if values is None:
+            values = self._kv_find('running_version/')
+        registrations = []
+        for key, value in sorted(values.iteritems()):
+            parts = key.split('/')
+            if len(parts) != 3 or not parts[2]:
+                continue
+            try:
+                timestamp = float(value)
+            except (TypeError, ValueError):
+                timestamp = 0
+            registrations.append((key, parts[1], parts[2], timestamp))
+        return registrations
+
+    @staticmethod
+    def _latest_registrations(registrations):
+        """
+        Map each host to its most recent registration
+        """
+        latest = {}
+        for registration in registrations:
+            host, timestamp = registration[2], registration[3]
+            if host not in latest or latest[host][3] < timestamp:
+                latest[host] = registration
+        return latest
+
+    def catalog_nodes(self):
+        """
+        The names of all nodes in the consul catalog
+        """
+        status, _, data = self._request('GET', 'catalog/nodes')
+        return set(node['Node'] for node in data or [])
+
+    def live_hosts(self, census):
+        """
+        The hosts registered in census that are still in the catalog.
+        Registrations of decommissioned hosts stay in /running_version
+        until gc prunes them, and those hosts will never converge.
+        """
+        return set().union(*census.values()) & self.catalog_nodes()
+
+    def gc(self, min_age=86400, dry_run=False):
+        """
+        Prune registrations that no longer describe the live fleet, so
+        reads of /running_version scale with the fleet rather than its
+        history. That is
+
+          * every registration of a host that has left the catalog, once
+            it is at least min_age seconds old, along with the host's
+            /host_version entry, and
+          * registrations superseded by a newer one of the same host,
+            which update_own_info would have removed had the host been
+            in the /host_version index at the time.
+
+        Deletes are sent in batched transactions unless dry_run is set.
+        Each is a check-and-set against the entry as it was read, so an
+        entry rewritten meanwhile (say by a host coming back) is kept:
+        the transaction it is in fails as a whole and gc raises. Running
+        it again starts from a fresh read.
+
+        Returns the list of keys removed (or that would be).
+        """
+        nodes, entries, host_versions = concurrently(
+            self.catalog_nodes,
+            lambda: self._kv_find('running_version/', indexes=True),
+            lambda: self._kv_find('host_version/', indexes=True))
+        registrations = self._registrations(dict((key, value) for key, (value, _)
+                                                 in entries.iteritems()))
+        latest = self._latest_registrations(registrations)
+        cutoff = time.time() - min_age
+        dead = set(host for host, r in latest.iteritems()
+                   if host not in nodes and r[3] <= cutoff)
+
+        keys = [key for key, version, host, timestamp in registrations
+                if host in dead or latest[host][0] != key]
+        keys += [key for key in ('host_version/%s' % host for host in sorted(dead))
+                 if key in host_versions]
+        if not dry_run:
+            entries.update(host_versions)
+            self._txn([self._kv_op('delete-cas', key, index=entries[key][1]) for key in keys],
+                      ordered=False)
+        return keys
+
+    def version_census(self):
+        """
+        Map every registered version to the set of hosts running it, from
+        a single keys-only read of /running_version. The other version
+        queries accept a census so several of them can share one read.
+        """
+        return self._build_census(self._kv_keys('running_version/'))
+
+    def census_snapshot(self, index=None, wait=None):
+        """
+        The version census along with the consul index it reflects. Given
+        an index, block until the census changes or wait seconds pass.
+        """
+        status, index, keys = self._request('GET', 'kv/running_version/', {'keys': None},
+                                            index=index, wait=wait)
+        if status == 404:
+            keys = []
+        return self._build_census(keys or []), index
+
+    @staticmethod
+    def merge_census(censuses):
+        """
+        Combine several censuses (e.g. one per datacenter) into one
+        """
+        merged = {}
+        for census in censuses:
+            for version, hosts in census.iteritems():
+                merged.setdefault(version, set()).update(hosts)
+        return merged
+
+    @staticmethod
+    def _build_census(keys):
+        census = {}
+        for key in keys:
+            parts = key.split('/')
+            if len(parts) < 2 or not parts[1]:
+                continue
+            hosts = census.setdefault(parts[1], set())
+            if len(parts) == 3 and parts[2]:
+                hosts.add(parts[2])
+        return census
+
+    def running_versions(self, census=None):
+        if census is None:
+            census = self.version_census()
+        return set(census)
+
+    def hosts_at_version(self, version, census=None):
+        if census is None:
+            census = self.version_census()
+        return census.get(version, set())
+
+    def health_summary(self):
+        """
+        Fetch the state of every check in the cluster with one request
+        """
+        return self.health_snapshot()[0]
+
+    def health_snapshot(self, index=None, wait=None):
+        """
+        The health summary along with the consul index it reflects. Given
+        an index, block until some check changes or wait seconds pass.
+        """
+        status, index, data = self._request('GET', 'health/state/any',
+                                            index=index, wait=wait)
+        return HealthSummary(data or []), index
+
+    def watch_fleet(self, wait=60, timeout=None, interval=None):
+        """
+        Generate (census, health summary) pairs: first the current state,
+        then a new pair whenever either of them changes. The census and the
+        health state are each followed by a blocking query, run in parallel
+        threads, so changes show up as soon as consul knows about them.
+        With interval, the latest pair is also generated again after
+        interval seconds without a change. Stops after timeout seconds.
+        """
+        import Queue
+        import threading
+        updates = Queue.Queue()
+        stop = threading.Event()
+
+        def follow(kind, snapshot):
+            index = None
+            backoff = 1
+            while not stop.is_set():
+                try:
+                    result, new_index = snapshot(index, wait)
+                except Exception:
+                    stop.wait(backoff)
+                    backoff = min(backoff * 2, 60)
+                    index = None
+                    continue
+                backoff = 1
+                if index is None or new_index != index:
+                    updates.put((kind, result))
+                index = self._next_index(index, new_index)
+
+        for kind, snapshot in (('census', self.census_snapshot),
+                               ('health', self.health_snapshot)):
+            thread = threading.Thread(target=follow, args=(kind, snapshot))
+            thread.daemon = True
+            thread.start()
+
+        deadline = timeout and time.time() + timeout
+        latest = {}
         try:
-            res = self.consul.kv.find('/running_version')
-            return set([x.split('/')[1] for x in res])
-        except (KeyError, IndexError):
-            return set()
-
-    # this call may not scale
-    # if pulls down all host version records as
-    # a single hash
-    def hosts_at_version(self, version):
-        version_dir = '/running_version/%s' % (version,)
+            while True:
+                # Queue.get without a timeout can not be interrupted
+                get_timeout = interval or wait
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    get_timeout = min(get_timeout, remaining)
+                try:
+                    kind, result = updates.get(timeout=get_timeout)
+                except Queue.Empty:
+                    if interval and len(latest) == 2:
+                        yield latest['census'], latest['health']
+                    continue
+                latest[kind] = result
+                if len(latest) == 2:
+                    yield latest['census'], latest['health']
+        finally:
+            stop.set()
+
+    def wait_for_convergence(self, version, hosts=None, timeout=3600, wait=60,
+                             verbose=False):
+        """
+        Wait until every one of hosts (by default every registered host
+        still in the catalog, see live_hosts) runs version and has no
+        failing checks. Returns False if that does not happen within
+        timeout seconds, after listing the hosts holding it up if verbose
+        is set.
+        """
+        view = None
+        for census, summary in self.watch_fleet(wait, timeout):
+            if view is None:
+                if hosts is None:
+                    hosts = self.live_hosts(census)
+                view = ConvergenceView(version, hosts)
+            view.update(census, summary)
+            if verbose:
+                print view
+                sys.stdout.flush()
+            if view.converged():
+                return True
+        if verbose and view is not None:
+            print 'Waiting on: %s' % ' '.join(view.lagging())
+        return False
+
+    def rollout(self, version, hosts=None, wave_size=10, concurrency=1,
+                timeout=None, wait=60, verbose=False, wave_timeout=3600):
+        """
+        Move hosts (by default every registered host still in the catalog,
+        see live_hosts) to version in waves of wave_size hosts, with up to
+        concurrency waves in flight at once.
+
+        Each wave is published as /target_version/<host> entries. A wave is
+        done when all its hosts have registered the new version and none
+        of them has failing checks (see watch_fleet), and the next wave is
+        published right away. When all waves are done, /current_version is
+        set to version and the per-host targets are removed.
+
+        Returns True on success, False if timeout seconds passed first or
+        a wave took longer than wave_timeout seconds. The hosts holding up
+        the waves in flight are then listed, and the rollout is left as it
+        is; trigger_update cancels it.
+        """
+        (entry, _), census = concurrently(lambda: self._kv_get('/current_version'),
+                                          lambda: hosts is None and self.version_census())
+        if entry is None:
+            raise ValueError('No current_version to roll out from. Use trigger_update')
+        previous = (entry['Value'] or '').strip()
+        if hosts is None:
+            hosts = sorted(self.live_hosts(census))
+        waves = [hosts[i:i + wave_size] for i in range(0, len(hosts), wave_size)]
+        pending = list(enumerate(waves, 1))
+        in_flight = []
+
+        fleet = self.watch_fleet(wait, timeout, wave_timeout and min(wait, wave_timeout))
         try:
-            res = self.consul.kv.find(version_dir)
-        except KeyError:
-            return []
-        result_set = set()
-        for x in res:
-            if x.split('/')[-2] == version:
-                result_set.add(x.split('/')[-1])
-        return result_set
-
-    def get_failures(self, hosts=False, show_warnings=False):
-        failures = self.consul.health.state('critical')
-        warnings = self.consul.health.state('warning')
-        # validation and puppet failures are being treated as warnings in consul
-        # that when they fail during bootstrapping, it does not cause services
-        # to be deregistered by consul. This code ensures that those "warnings"
-        # are treated as failures in this context
-        puppet_failures = [w for w in warnings if w['Name'] == 'puppet']
-        validation_failures = [w for w in warnings if w['Name'] == 'validation']
-        failures = failures + puppet_failures + validation_failures
+            for census, summary in fleet:
+                while True:
+                    while pending and len(in_flight) < concurrency:
+                        n, wave = pending.pop(0)
+                        # Rewriting /current_version (with the flag) last
+                        # wakes up hosts watching it, which then find their
+                        # new target. Targets left by an earlier rollout
+                        # that was given up go with the first wave.
+                        ops = [self._kv_op('set', 'target_version/%s' % host, version)
+                               for host in wave]
+                        if n == 1:
+                            ops.insert(0, self._kv_op('delete-tree', 'target_version/'))
+                        self._txn(ops + [self._kv_op('set', 'current_version', previous,
+                                                     self.ROLLOUT_FLAG)])
+                        in_flight.append((n, wave, ConvergenceView(version, wave),
+                                          time.time()))
+                        if verbose:
+                            print 'Wave %d/%d started: %s' % (n, len(waves), ' '.join(wave))
+                    done = []
+                    for item in in_flight:
+                        item[2].update(census, summary)
+                        if item[2].converged():
+                            done.append(item)
+                    for item in done:
+                        in_flight.remove(item)
+                        if verbose:
+                            print 'Wave %d/%d done' % (item[0], len(waves))
+                    if not done or not (pending or in_flight):
+                        break
+                if not (pending or in_flight):
+                    break
+                oldest = min(item[3] for item in in_flight)
+                if wave_timeout and oldest + wave_timeout <= time.time():
+                    break
+        finally:
+            fleet.close()
+
+        if pending or in_flight:
+            for n, wave, view, started in in_flight:
+                print 'Wave %d/%d waiting on: %s' % (n, len(waves), ' '.join(view.lagging()))
+            return False
+
+        self._txn([self._kv_op('set', 'current_version', version),
+                   self._kv_op('delete-tree', 'target_version/')])
+        if verbose:
+            print 'Rollout of %s complete' % (version,)
+        return True
+
+    def get_failures(self, hosts=False, show_warnings=False, summary=None):
+        if summary is None:
+            summary = self.health_summary()
         if hosts:
-            if len(failures) != 0: print "Failures:"
-            for x in failures:
+            if summary.failures: print "Failures:"
+            for x in summary.failures:
                 print "  Node: %s, Check: %s" % (x['Node'], x['Name'])
-        other_warnings = [w for w in warnings if w['Name'] != 'validation' and w['Name'] != 'puppet']
-        if show_warnings:
-            if hosts:
-                if len(other_warnings) != 0: print "Warnings:"
-                for x in other_warnings:
+            if show_warnings:
+                if summary.warnings: print "Warnings:"
+                for x in summary.warnings:
                     print "  Node: %s, Check: %s" % (x['Node'], x['Name'])
-            failures = failures + other_warnings
-        return len(failures) == 0
+        return summary.healthy(show_warnings)
 
-    def verify_hosts(self, version, hosts):
-        return set(hosts).issubset(self.hosts_at_version(version))
+    def verify_hosts(self, version, hosts, census=None):
+        return set(hosts).issubset(self.hosts_at_version(version, census))
 
-    def check_single_version(self, version, verbose=False):
-        running_versions = self.running_versions()
+    def check_single_version(self, version, verbose=False, census=None):
+        running_versions = self.running_versions(census)
         unwanted_versions = filter(lambda x: x != version,
                                    running_versions)
         wanted_version_found = version in running_versions
@@ -195,47 +1293,205 @@ class DeploymentOrchestrator(object):
             raise
 
 
-def main(argv=sys.argv[1:]):
+DEFAULT_SOCKET = '/var/run/jorc.sock'
+
+# subcommands that never run inside a jorc serve daemon
+LOCAL_SUBCOMMANDS = ('serve', 'watch_update', 'rollout', 'wait_for_convergence',
+                     'handle_event')
+# subcommands whose stdin is passed along to the daemon
+STDIN_SUBCOMMANDS = ('verify_hosts',)
+
+# Subcommands that can query several datacenters at once (see --dc)
+DC_SUBCOMMANDS = ('get_failures', 'running_versions', 'check_single_version')
+
+
+def exit_code(value):
+    """
+    Turn a main() return value or SystemExit code into the exit status
+    sys.exit would give the process
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (int, long)):
+        return int(value)
+    return 1
+
+
+def forward(path, argv, stdin=''):
+    """
+    Run a jorc command in the jorc serve daemon listening on path.
+
+    Returns the command's exit code after copying its output to our
+    stdout/stderr, or None if no daemon could be reached.
+    """
+    import json
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return None
+        sock.sendall(json.dumps({'argv': argv, 'stdin': stdin}))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    response = json.loads(''.join(chunks))
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['rc']
+
+
+def main(argv=sys.argv[1:], orchestrators=None, keepalive=None):
+    """
+    Run a jorc subcommand. orchestrators is the cache of
+    DeploymentOrchestrators kept by a jorc serve daemon, and is None when
+    running standalone. keepalive is how often the daemon re-sends the
+    state of TTL checks (see StatusReporter).
+    """
     parser = argparse.ArgumentParser(description='Utility for '
                                                  'orchestrating updates')
     parser.add_argument('--host', type=str,
                         default='127.0.0.1', help="local consul agent")
     parser.add_argument('--port', type=int, default=8500, help="consul port")
+    parser.add_argument('--consistency', choices=DeploymentOrchestrator.CONSISTENCY_MODES,
+                        default='default', help="Consistency mode for reads from consul")
+    parser.add_argument('--cache-file', type=str,
+                        help="Keep the last known current_version in this file")
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help="Seconds to trust the cached current_version without asking consul")
+    parser.add_argument('--max-stale', type=float,
+                        help="Seconds the cached current_version may be used while consul is unreachable "
+                             "(default: no limit)")
+    parser.add_argument('--dc', action='append', default=[],
+                        help="Consul datacenter to query. %s query several at once, "
+                             "given a comma separated list or --dc more than once"
+                             % ', '.join(DC_SUBCOMMANDS))
+    parser.add_argument('--all-dcs', action='store_true',
+                        help="Query every known datacenter (%s only)" % ', '.join(DC_SUBCOMMANDS))
+    parser.add_argument('--timings', action='store_true',
+                        help="Print a summary of the consul calls made to stderr")
+    parser.add_argument('--metrics-file', type=str,
+                        help="Add counts and latencies of the consul calls made to this "
+                             "node_exporter textfile collector file")
+    parser.add_argument('--socket', type=str, default=os.environ.get('JORC_SOCKET'),
+                        help="Run the command in the jorc serve daemon listening on this "
+                             "socket, if there is one (default: $JORC_SOCKET)")
     subparsers = parser.add_subparsers(dest='subcmd')
 
+    serve_parser = subparsers.add_parser('serve',
+                                         help='Serve jorc commands on a unix socket')
+    serve_parser.add_argument('--keepalive', type=int,
+                              help="Seconds between re-sends of each TTL check's state. "
+                                   "Keep this well under the checks' TTL (default: 30)")
+
     trigger_parser = subparsers.add_parser('trigger_update',
                                            help='Trigger an update')
     trigger_parser.add_argument('version', type=str, help='Version to deploy')
+    trigger_parser.add_argument('--event', action='store_true',
+                                help="Also fire a %s consul event so hosts running "
+                                     "handle_event update right away" % DeploymentOrchestrator.UPDATE_EVENT)
+
+    handle_event_parser = subparsers.add_parser('handle_event',
+                                                help='Handle %s events, as the handler of a '
+                                                     'consul event watch' % DeploymentOrchestrator.UPDATE_EVENT)
+    handle_event_parser.add_argument('--hook', type=str,
+                                     help="Command to run (with the new version as last argument) "
+                                          "when a new version is announced. If not given, print it")
+    handle_event_parser.add_argument('--state-file', type=str,
+                                     help="File to remember the last event handled in")
 
     current_version_parser = subparsers.add_parser('current_version',
                                                    help='Get available version')
 
     ping_parser = subparsers.add_parser('ping', help='Ping consul')
 
+    watch_update_parser = subparsers.add_parser('watch_update',
+                                                help='Wait for an update to become available')
+    watch_update_parser.add_argument('--hook', type=str,
+                                     help="Command to run (with the new version as last argument) for every update. "
+                                          "If not given, print the new version and exit")
+    watch_update_parser.add_argument('--wait', type=int, default=300,
+                                     help="Seconds consul may hold each blocking query open")
+    watch_update_parser.add_argument('--hostname', type=str, default=None,
+                                     help="This system's hostname (default: from the system)")
+
+    convergence_parser = subparsers.add_parser('wait_for_convergence',
+                                               help='Wait until hosts run a version and are healthy')
+    convergence_parser.add_argument('version', type=str, help='Version to wait for')
+    convergence_parser.add_argument('--hosts-file', type=str,
+                                    help="File listing the hosts to wait for, one per line "
+                                         "(default: every registered host in the catalog)")
+    convergence_parser.add_argument('--timeout', type=int, default=3600,
+                                    help="Give up after this many seconds")
+
+    rollout_parser = subparsers.add_parser('rollout', help='Roll out a new version in waves of hosts')
+    rollout_parser.add_argument('version', type=str, help='Version to deploy')
+    rollout_parser.add_argument('--hosts-file', type=str,
+                                help="File listing the hosts to update, one per line, in order "
+                                     "(default: every registered host in the catalog)")
+    rollout_parser.add_argument('--wave-size', type=int, default=10, help="Hosts per wave")
+    rollout_parser.add_argument('--concurrency', type=int, default=1,
+                                help="Number of waves allowed in flight at once")
+    rollout_parser.add_argument('--timeout', type=int, help="Give up after this many seconds")
+    rollout_parser.add_argument('--wave-timeout', type=int, default=3600,
+                                help="Give up if a wave takes longer than this many seconds")
+    rollout_parser.add_argument('--verbose', '-v', action='store_true', help='Be verbose')
+
     pending_update = subparsers.add_parser('pending_update',
                                            help='Check for pending update')
+    pending_update.add_argument('--hostname', type=str, default=None,
+                                help="This system's hostname (default: from the system)")
 
     local_health_parser = subparsers.add_parser('local_health', help='Check health of local system')
     local_health_parser.add_argument('--verbose', '-v', action='store_true', help='Be verbose')
+    local_health_parser.add_argument('--server', action='store_true',
+                                     help="Ask the consul servers rather than the local agent")
+    local_health_parser.add_argument('--hostname', type=str, default=None,
+                                     help="Host to ask the servers about (default: this system)")
+    local_health_parser.add_argument('--watch', action='store_true',
+                                     help="Keep running, printing the failing checks whenever they change")
+    local_health_parser.add_argument('--interval', type=float, default=5,
+                                     help="Seconds between polls of the local agent in --watch mode")
 
     local_version_parser = subparsers.add_parser('local_version',
                                                  help='Get or set local version')
     local_version_parser.add_argument('version', nargs='?', help="If given, set this as the local version")
     update_own_status_parser = subparsers.add_parser('update_own_status', help="Update info related to the current status of a host")
-    update_own_status_parser.add_argument('--hostname', type=str, default=socket.gethostname(),
-                                          help="This system's hostname")
+    update_own_status_parser.add_argument('--hostname', type=str, default=None,
+                                          help="This system's hostname (default: from the system)")
     update_own_status_parser.add_argument('status_type', type=str, help="Type of status to update")
     update_own_status_parser.add_argument('status_result', type=int, help="Command exit code used to derive status")
     list_failures_parser = subparsers.add_parser('get_failures', help="Return a list of every failed host. Returns the number of hosts in a failed state")
     list_failures_parser.add_argument('--hosts', action='store_true', help="list out all hosts in each state and not just the number in each state")
     list_failures_parser.add_argument('--show_warnings', action='store_true', help="Whether to count warnings as failures")
+    list_failures_parser.add_argument('--json', action='store_true', help="Print failures, warnings and per node/check/status counts as JSON")
     update_own_info_parser = subparsers.add_parser('update_own_info', help="Update host's own info")
-    update_own_info_parser.add_argument('--hostname', type=str, default=socket.gethostname(),
-                                        help="This system's hostname")
+    update_own_info_parser.add_argument('--hostname', type=str, default=None,
+                                        help="This system's hostname (default: from the system)")
     update_own_info_parser.add_argument('--version', type=str,
                                         help="Override version to report into consul")
 
+    host_version_parser = subparsers.add_parser('host_version', help="Show the version a host last registered")
+    host_version_parser.add_argument('--hostname', type=str, default=None,
+                                     help="Host to look up (default: this system)")
+
+    backfill_parser = subparsers.add_parser('backfill_host_versions', help="Build the host_version index from running_version")
+    backfill_parser.add_argument('--dry-run', action='store_true', help="Only print what would be written")
+
+    gc_parser = subparsers.add_parser('gc', help="Remove registrations of hosts that have left the catalog")
+    gc_parser.add_argument('--min-age', type=int, default=86400,
+                           help="Keep registrations of unknown hosts younger than this many seconds (default: 86400)")
+    gc_parser.add_argument('--dry-run', action='store_true', help="Only print what would be removed")
+
     running_versions_parser = subparsers.add_parser('running_versions', help="List currently running versions")
+    version_census_parser = subparsers.add_parser('version_census', help="List every running version with its hosts")
+    version_census_parser.add_argument('--json', action='store_true', help="Print the census as a JSON object")
     hosts_at_version_parser = subparsers.add_parser('hosts_at_version', help="List hosts at specified version")
     hosts_at_version_parser.add_argument('version', type=str, help="Version to retrieve list of hosts for")
 
@@ -246,18 +1502,118 @@ def main(argv=sys.argv[1:]):
     check_single_version_parser.add_argument('version', help='The version to check for')
     check_single_version_parser.add_argument('--verbose', '-v', action='store_true', help='Be verbose')
     args = parser.parse_args(argv)
+    args.dc = [dc for value in args.dc for dc in value.split(',') if dc]
+    if args.subcmd not in DC_SUBCOMMANDS and (args.all_dcs or len(args.dc) > 1):
+        parser.error('%s can only query one datacenter' % args.subcmd)
+
+    options = {'host': args.host,
+               'port': args.port,
+               'cache_path': args.cache_file,
+               'cache_ttl': args.cache_ttl,
+               'max_stale': args.max_stale,
+               'consistency': args.consistency,
+               'datacenter': None}
+    if args.subcmd not in DC_SUBCOMMANDS and args.dc:
+        options['datacenter'] = args.dc[0]
+    # watching ties up the process for good
+    local = args.subcmd in LOCAL_SUBCOMMANDS or getattr(args, 'watch', False)
+    if orchestrators is None:
+        if args.socket and not local:
+            stdin = args.subcmd in STDIN_SUBCOMMANDS and sys.stdin.read() or ''
+            rc = forward(args.socket, argv, stdin)
+            if rc is not None:
+                return rc
+            if stdin:
+                sys.stdin = StringIO.StringIO(stdin)
+        do = DeploymentOrchestrator(**options)
+    elif local:
+        parser.error('%s can not be run through jorc serve' % ' '.join(argv))
+    else:
+        key = tuple(sorted(options.items()))
+        do = orchestrators.get(key)
+        if do is None:
+            from jiocloud.orchestrate_daemon import StatusReporter
+            do = orchestrators[key] = DeploymentOrchestrator(**options)
+            do.status_reporter = StatusReporter(do, keepalive or StatusReporter.KEEPALIVE)
+
+    if getattr(args, 'hostname', '') is None:
+        args.hostname = socket.gethostname()
+
+    do.metrics = ConsulMetrics(args.subcmd)
+    try:
+        if local:
+            return run(do, args)
+        with do.snapshot():
+            return run(do, args)
+    finally:
+        if args.timings:
+            sys.stderr.write(do.metrics.summary())
+        if args.metrics_file:
+            do.metrics.write_textfile(args.metrics_file)
+
 
-    do = DeploymentOrchestrator(args.host, args.port)
-    if args.subcmd == 'trigger_update':
-        do.trigger_update(args.version)
+def run(do, args):
+    """
+    Run the subcommand parsed by main using do
+    """
+    if args.subcmd in DC_SUBCOMMANDS and (args.dc or args.all_dcs):
+        return run_across_datacenters(do, args, args.all_dcs and do.datacenters() or args.dc)
+    if args.subcmd == 'serve':
+        from jiocloud.orchestrate_daemon import CommandServer
+        server = CommandServer(args.socket or DEFAULT_SOCKET, args.keepalive)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(server.server_address)
+    elif args.subcmd == 'trigger_update':
+        do.trigger_update(args.version, args.event)
+    elif args.subcmd == 'handle_event':
+        import json
+        # consul logs a watch handler's failures, so having nothing to do
+        # is not one, but a failed hook is
+        version, status = do.handle_update_events(json.load(sys.stdin) or [],
+                                                  args.hook, args.state_file)
+        if version is not None and not args.hook:
+            print version
+        return status
     elif args.subcmd == 'current_version':
         print do.current_version()
+    elif args.subcmd == 'watch_update':
+        print do.watch_update(args.hook, args.wait, args.hostname)
+    elif args.subcmd in ('rollout', 'wait_for_convergence'):
+        hosts = None
+        if args.hosts_file:
+            with open(args.hosts_file) as fp:
+                hosts = [l.strip() for l in fp if l.strip()]
+        if args.subcmd == 'wait_for_convergence':
+            if not do.wait_for_convergence(args.version, hosts, args.timeout, verbose=True):
+                print 'Timed out waiting for convergence on %s' % (args.version,)
+                return 1
+        elif not do.rollout(args.version, hosts, args.wave_size, args.concurrency,
+                            args.timeout, verbose=args.verbose,
+                            wave_timeout=args.wave_timeout):
+            print 'Timed out waiting for rollout of %s' % (args.version,)
+            return 1
     elif args.subcmd == 'check_single_version':
         sys.exit(not do.check_single_version(args.version, args.verbose))
     elif args.subcmd == 'update_own_status':
-        do.update_own_status(args.hostname, args.status_type, args.status_result)
+        (do.status_reporter or do).update_own_status(args.hostname, args.status_type,
+                                                     args.status_result)
     elif args.subcmd == 'update_own_info':
         do.update_own_info(args.hostname, version=args.version)
+    elif args.subcmd == 'host_version':
+        version = do.host_version(args.hostname)
+        if version is None:
+            return 1
+        print version
+    elif args.subcmd == 'backfill_host_versions':
+        for host, version in sorted(do.backfill_host_versions(args.dry_run).iteritems()):
+            print '%s: %s' % (host, version)
+    elif args.subcmd == 'gc':
+        keys = do.gc(args.min_age, args.dry_run)
+        for key in keys:
+            print '%s %s' % (args.dry_run and 'Would remove' or 'Removed', key)
+        print '%d keys %s' % (len(keys), args.dry_run and 'to remove' or 'removed')
     elif args.subcmd == 'ping':
         did_it_work = do.ping()
         if did_it_work:
@@ -270,6 +1626,15 @@ def main(argv=sys.argv[1:]):
         print do.local_version(args.version)
     elif args.subcmd == 'running_versions':
         print '\n'.join(do.running_versions())
+    elif args.subcmd == 'version_census':
+        import json
+        census = do.version_census()
+        if args.json:
+            print json.dumps(dict((v, sorted(h)) for v, h in census.iteritems()),
+                             sort_keys=True)
+        else:
+            for version, hosts in sorted(census.iteritems()):
+                print '%s: %s' % (version, ' '.join(sorted(hosts)))
     elif args.subcmd == 'hosts_at_version':
         print '\n'.join(do.hosts_at_version(args.version))
     elif args.subcmd == 'verify_hosts':
@@ -277,12 +1642,27 @@ def main(argv=sys.argv[1:]):
         hosts = buffer.split('\n')
         return not do.verify_hosts(args.version, hosts)
     elif args.subcmd == 'get_failures':
-        return not do.get_failures(args.hosts, args.show_warnings)
+        summary = do.health_summary()
+        if args.json:
+            import json
+            print json.dumps(summary.as_dict(args.show_warnings), sort_keys=True)
+            return not summary.healthy(args.show_warnings)
+        return not do.get_failures(args.hosts, args.show_warnings, summary)
     elif args.subcmd == 'local_health':
-        failures = do.local_health(socket.gethostname(), args.verbose)
+        if args.watch:
+            for failures in do.watch_local_health(args.hostname, args.server,
+                                                  interval=args.interval):
+                print '%s %s' % (time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                 failures and 'failing: %s' % ', '.join(x['Name'] for x in failures)
+                                 or 'healthy')
+                if args.verbose:
+                    for x in failures:
+                        print '  %s: %s' % (x['Name'], x['Output'])
+                sys.stdout.flush()
+        failures = do.local_health(args.hostname, args.verbose, args.server)
         return len(failures)
     elif args.subcmd == 'pending_update':
-        pending_update = do.pending_update()
+        pending_update = do.pending_update(args.hostname)
         msg = {do.UPDATE_AVAILABLE: "Yes, there is an update pending",
                do.UP_TO_DATE: "No updates pending",
                do.NO_CLUE: "Could not get current_version",
@@ -291,5 +1671,42 @@ def main(argv=sys.argv[1:]):
         print msg
         return pending_update
 
+
+def run_across_datacenters(do, args, datacenters):
+    """
+    Run one of DC_SUBCOMMANDS against all of datacenters at once. The
+    result for each datacenter is printed, followed by the merged result
+    which decides the exit code.
+    """
+    if args.subcmd == 'get_failures':
+        summaries = do.across_datacenters(datacenters, lambda dc_do: dc_do.health_summary())
+        merged = HealthSummary.merge([summaries[dc] for dc in datacenters])
+        if args.json:
+            import json
+            print json.dumps({'datacenters': dict((dc, summary.as_dict(args.show_warnings))
+                                                  for dc, summary in summaries.iteritems()),
+                              'merged': merged.as_dict(args.show_warnings)},
+                             sort_keys=True)
+        else:
+            for dc in datacenters:
+                summary = summaries[dc]
+                print '%s: %d failures, %d warnings' % (dc, len(summary.failures),
+                                                        len(summary.warnings))
+                do.get_failures(args.hosts, args.show_warnings, summary)
+        return not merged.healthy(args.show_warnings)
+
+    censuses = do.across_datacenters(datacenters, lambda dc_do: dc_do.version_census())
+    merged = do.merge_census(censuses.values())
+    if args.subcmd == 'running_versions':
+        for dc in datacenters:
+            print '%s: %s' % (dc, ' '.join(sorted(do.running_versions(censuses[dc]))))
+        print 'merged: %s' % ' '.join(sorted(do.running_versions(merged)))
+    elif args.subcmd == 'check_single_version':
+        for dc in datacenters:
+            single = do.check_single_version(args.version, census=censuses[dc])
+            print '%s: %s' % (dc, single and 'single version' or 'mixed versions')
+        return not do.check_single_version(args.version, args.verbose, merged)
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
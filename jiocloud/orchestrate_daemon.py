@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+#    Copyright Reliance Jio Infocomm, Ltd.
+#    Author: Soren Hansen <Soren.Hansen@ril.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""
+Daemon side of jorc serve: runs jorc subcommands sent over a unix socket
+by jiocloud.orchestrate.forward
+"""
+import json
+import os
+import SocketServer
+import StringIO
+import sys
+import threading
+import time
+import traceback
+from jiocloud import orchestrate
+
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.read())
+        response = self.server.run(request['argv'], request.get('stdin', ''))
+        self.wfile.write(json.dumps(response))
+
+
+class CommandServer(SocketServer.UnixStreamServer):
+    """
+    Runs jorc subcommands received on a unix socket, keeping one
+    DeploymentOrchestrator (and so one set of consul connections) per
+    consul agent across requests. Requests are handled one at a time,
+    since each one temporarily takes over stdin/stdout/stderr.
+    """
+    def __init__(self, path, keepalive=None):
+        if os.path.exists(path):
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+        self.orchestrators = {}
+        # see StatusReporter
+        self.keepalive = keepalive
+
+    def run(self, argv, stdin=''):
+        saved = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin = StringIO.StringIO(stdin)
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        try:
+            try:
+                rc = orchestrate.exit_code(orchestrate.main(argv, self.orchestrators,
+                                                            self.keepalive))
+            except SystemExit, e:
+                if isinstance(e.code, basestring):
+                    print >>sys.stderr, e.code
+                rc = orchestrate.exit_code(e.code)
+            except Exception:
+                traceback.print_exc()
+                rc = 1
+            return {'rc': rc,
+                    'stdout': sys.stdout.getvalue(),
+                    'stderr': sys.stderr.getvalue()}
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+
+
+class StatusReporter(object):
+    """
+    Takes over update_own_status for the commands run by jorc serve.
+    Repeated results are coalesced: only a change of state is sent to
+    the agent, while the command waits, so failing to reach the agent
+    fails the command. Every check's state is re-sent each keepalive
+    seconds from a background thread so its TTL never runs out.
+    Everything goes over the orchestrator's persistent connection to the
+    agent.
+    """
+    KEEPALIVE = 30
+    # seconds to wait before retrying a failed update
+    RETRY = 5
+
+    def __init__(self, do, keepalive=KEEPALIVE):
+        self.do = do
+        self.keepalive = keepalive
+        # check id -> state ('pass' or 'warn')
+        self.states = {}
+        # check id -> when its state is next due to be sent
+        self.due = {}
+        self.cond = threading.Condition()
+        # held while sending, so a keepalive never overtakes a change
+        self.sending = threading.Lock()
+        self.thread = None
+
+    def update_own_status(self, hostname, status_type, status_result):
+        state = self.do.own_status(status_type, status_result)
+        with self.sending:
+            with self.cond:
+                if self.states.get(status_type) == state:
+                    return
+            self.do.check_ttl(status_type, state)
+            with self.cond:
+                self.states[status_type] = state
+                self.due[status_type] = time.time() + self.keepalive
+                self.cond.notify()
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def flush(self, now=None):
+        """
+        Send the state of every check that is due. Returns the number of
+        seconds until the next one is.
+        """
+        now = now or time.time()
+        with self.sending:
+            with self.cond:
+                due = [(check, self.states[check])
+                       for check, when in sorted(self.due.iteritems()) if when <= now]
+                for check, state in due:
+                    self.due[check] = now + self.keepalive
+            for check, state in due:
+                try:
+                    self.do.check_ttl(check, state)
+                except Exception:
+                    # not to the stderr of whichever command is being run
+                    traceback.print_exc(file=sys.__stderr__)
+                    with self.cond:
+                        self.due[check] = min(self.due[check], now + self.RETRY)
+        with self.cond:
+            return max(min(self.due.values()) - now, 0)
+
+    def run(self):
+        while True:
+            wait = self.flush()
+            with self.cond:
+                if wait:
+                    self.cond.wait(wait)
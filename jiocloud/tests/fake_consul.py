@@ -0,0 +1,316 @@
+#    Copyright Reliance Jio Infocomm, Ltd.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""
+An in-process stand-in for the parts of the consul HTTP API jorc uses: KV
+(including recurse, keys and blocking queries), transactions, health,
+agent checks and the catalog. It runs a tornado IOLoop in a thread and
+keeps everything in memory.
+"""
+import base64
+import json
+import socket
+import threading
+import time
+
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.locks
+import tornado.netutil
+import tornado.web
+
+
+class FakeConsul(object):
+    def __init__(self, node='node1', datacenter='dc1'):
+        self.node = node
+        self.datacenter = datacenter
+        self.index = 1
+        self.kv = {}
+        # node -> {check id: check}
+        self.checks = {}
+        self.nodes = set()
+        self.port = None
+        self._changed = None
+        self._ioloop = None
+        self._thread = None
+
+    # State manipulation. These may be called from any thread while the
+    # server is running, as the server only reads state in its own thread.
+
+    def bump(self, index=None):
+        """
+        Publish a change: blocked queries wake once the state is in place
+        """
+        self.index = index or self.index + 1
+        if self._changed is not None:
+            self._ioloop.add_callback(self._changed.notify_all)
+        return self.index
+
+    def set(self, key, value, flags=0):
+        key = key.lstrip('/')
+        index = self.index + 1
+        entry = self.kv.get(key)
+        self.kv[key] = {'Key': key, 'Value': value, 'Flags': flags,
+                        'CreateIndex': entry and entry['CreateIndex'] or index,
+                        'ModifyIndex': index, 'LockIndex': 0}
+        self.bump(index)
+
+    def delete(self, key, recurse=False):
+        key = key.lstrip('/')
+        if recurse:
+            for k in [k for k in self.kv if k.startswith(key)]:
+                del self.kv[k]
+        else:
+            self.kv.pop(key, None)
+        self.bump()
+
+    def set_check(self, node, name, status, output=''):
+        self.nodes.add(node)
+        self.checks.setdefault(node, {})[name] = {
+            'Node': node, 'CheckID': name, 'Name': name, 'Status': status,
+            'Output': output, 'Notes': '', 'ServiceID': '', 'ServiceName': ''}
+        self.bump()
+
+    def seed(self, hosts, versions, current_version=None, failing=0):
+        """
+        Register hosts spread evenly over versions, with the usual serf,
+        puppet and validation checks. The first failing hosts have a
+        failed puppet run.
+        """
+        now = str(time.time())
+        for i in range(hosts):
+            host = 'host%d' % i
+            version = versions[i % len(versions)]
+            self.kv['running_version/%s/%s' % (version, host)] = self._entry(
+                'running_version/%s/%s' % (version, host), now)
+            self.kv['host_version/%s' % host] = self._entry('host_version/%s' % host, version)
+            self.nodes.add(host)
+            self.checks[host] = {}
+            for name in ('serfHealth', 'puppet', 'validation'):
+                status = (name == 'puppet' and i < failing) and 'warning' or 'passing'
+                self.checks[host][name] = {'Node': host, 'CheckID': name, 'Name': name,
+                                           'Status': status, 'Output': '',
+                                           'Notes': '', 'ServiceID': '', 'ServiceName': ''}
+        if current_version:
+            self.kv['current_version'] = self._entry('current_version', current_version)
+        self.bump()
+
+    def _entry(self, key, value):
+        return {'Key': key, 'Value': value, 'Flags': 0, 'CreateIndex': self.index,
+                'ModifyIndex': self.index, 'LockIndex': 0}
+
+    # Server lifecycle
+
+    def start(self):
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1', family=socket.AF_INET)
+        self.port = sockets[0].getsockname()[1]
+        started = threading.Event()
+
+        def run():
+            self._ioloop = tornado.ioloop.IOLoop()
+            self._ioloop.make_current()
+            self._changed = tornado.locks.Condition()
+            server = tornado.httpserver.HTTPServer(self.application())
+            server.add_sockets(sockets)
+            started.set()
+            self._ioloop.start()
+            server.stop()
+            self._ioloop.run_sync(server.close_all_connections)
+            self._ioloop.close(all_fds=True)
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        self._ioloop.add_callback(self._ioloop.stop)
+        self._thread.join()
+
+    def application(self):
+        args = {'consul': self}
+        return tornado.web.Application([
+            (r'/v1/kv/(.*)', KVHandler, args),
+            (r'/v1/txn', TxnHandler, args),
+            (r'/v1/health/state/(.*)', HealthStateHandler, args),
+            (r'/v1/health/node/(.*)', HealthNodeHandler, args),
+            (r'/v1/agent/checks', AgentChecksHandler, args),
+            (r'/v1/agent/check/(pass|warn|fail)/(.*)', AgentCheckUpdateHandler, args),
+            (r'/v1/agent/members', AgentMembersHandler, args),
+            (r'/v1/catalog/nodes', CatalogNodesHandler, args),
+            (r'/v1/catalog/datacenters', CatalogDatacentersHandler, args),
+        ])
+
+
+class ConsulHandler(tornado.web.RequestHandler):
+    def initialize(self, consul):
+        self.consul = consul
+
+    def flag(self, name):
+        return name in self.request.arguments
+
+    @tornado.gen.coroutine
+    def block(self):
+        """
+        Implement blocking queries: hold the request until consul's index
+        moves past ?index or ?wait passes
+        """
+        index = self.get_argument('index', None)
+        if index is None:
+            return
+        wait = self.get_argument('wait', '300s')
+        if wait.endswith('ms'):
+            seconds = float(wait[:-2]) / 1000
+        elif wait.endswith('m'):
+            seconds = float(wait[:-1]) * 60
+        else:
+            seconds = float(wait.rstrip('s'))
+        deadline = time.time() + seconds
+        while self.consul.index <= int(index) and time.time() < deadline:
+            yield self.consul._changed.wait(timeout=deadline)
+
+    def reply(self, data, status=200):
+        self.set_status(status)
+        self.set_header('X-Consul-Index', str(self.consul.index))
+        if data is not None:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(data))
+
+
+def encode(entry):
+    entry = dict(entry)
+    if entry['Value'] is not None:
+        entry['Value'] = base64.b64encode(entry['Value'])
+    return entry
+
+
+class KVHandler(ConsulHandler):
+    @tornado.gen.coroutine
+    def get(self, key):
+        yield self.block()
+        kv = self.consul.kv
+        if self.flag('keys'):
+            result = sorted(k for k in kv if k.startswith(key))
+        elif self.flag('recurse'):
+            result = [encode(kv[k]) for k in sorted(kv) if k.startswith(key)]
+        else:
+            result = key in kv and [encode(kv[key])] or []
+        if not result:
+            self.reply(None, 404)
+        else:
+            self.reply(result)
+
+    def put(self, key):
+        self.consul.set(key, self.request.body, int(self.get_argument('flags', 0)))
+        self.reply(True)
+
+    def delete(self, key):
+        self.consul.delete(key, self.flag('recurse'))
+        self.reply(True)
+
+
+class TxnHandler(ConsulHandler):
+    def put(self):
+        ops = json.loads(self.request.body)
+        if len(ops) > 64:
+            self.reply(None, 413)
+            return
+        # Check-and-set operations fail the whole transaction before
+        # anything is applied
+        errors = []
+        for i, op in enumerate(ops):
+            op = op['KV']
+            entry = self.consul.kv.get(op['Key'])
+            if op['Verb'] == 'delete-cas' and entry and entry['ModifyIndex'] != op['Index']:
+                errors.append({'OpIndex': i,
+                               'What': 'current modify index %d does not match %d' % (
+                                   entry['ModifyIndex'], op['Index'])})
+        if errors:
+            self.reply({'Results': None, 'Errors': errors}, 409)
+            return
+        results = []
+        for op in ops:
+            op = op['KV']
+            verb = op['Verb']
+            if verb == 'set':
+                value = op.get('Value') is not None and base64.b64decode(op['Value']) or None
+                self.consul.set(op['Key'], value, op.get('Flags', 0))
+            elif verb in ('delete', 'delete-cas'):
+                self.consul.delete(op['Key'])
+            elif verb == 'delete-tree':
+                self.consul.delete(op['Key'], recurse=True)
+            elif verb == 'get':
+                if op['Key'] not in self.consul.kv:
+                    self.reply({'Results': None,
+                                'Errors': [{'OpIndex': len(results),
+                                            'What': 'key "%s" doesn\'t exist' % op['Key']}]}, 409)
+                    return
+                results.append({'KV': encode(self.consul.kv[op['Key']])})
+                continue
+            else:
+                self.reply(None, 400)
+                return
+            results.append({'KV': {'Key': op['Key']}})
+        self.reply({'Results': results, 'Errors': None})
+
+
+class HealthStateHandler(ConsulHandler):
+    @tornado.gen.coroutine
+    def get(self, state):
+        yield self.block()
+        self.reply([check for node in sorted(self.consul.checks)
+                    for _, check in sorted(self.consul.checks[node].iteritems())
+                    if state == 'any' or check['Status'] == state])
+
+
+class HealthNodeHandler(ConsulHandler):
+    @tornado.gen.coroutine
+    def get(self, node):
+        yield self.block()
+        self.reply([check for _, check in sorted(self.consul.checks.get(node, {}).iteritems())])
+
+
+class AgentChecksHandler(ConsulHandler):
+    def get(self):
+        self.reply(self.consul.checks.get(self.consul.node, {}))
+
+
+class AgentCheckUpdateHandler(ConsulHandler):
+    STATUS = {'pass': 'passing', 'warn': 'warning', 'fail': 'critical'}
+
+    def put(self, action, check_id):
+        if check_id not in self.consul.checks.get(self.consul.node, {}):
+            self.reply(None, 500)
+            return
+        self.consul.set_check(self.consul.node, check_id, self.STATUS[action],
+                              self.get_argument('note', ''))
+        self.reply(None)
+
+
+class AgentMembersHandler(ConsulHandler):
+    def get(self):
+        self.reply([{'Name': node, 'Status': 1} for node in sorted(self.consul.nodes)])
+
+
+class CatalogNodesHandler(ConsulHandler):
+    def get(self):
+        self.reply([{'Node': node, 'Address': '127.0.0.1'}
+                    for node in sorted(self.consul.nodes)])
+
+
+class CatalogDatacentersHandler(ConsulHandler):
+    def get(self):
+        self.reply([self.consul.datacenter])
@@ -13,12 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 #
+import itertools
+import json
 import mock
 import os
+import shutil
 import StringIO
+import tempfile
+import threading
 import unittest
 from contextlib import nested
-from jiocloud.apply_resources import ApplyResources
+from jiocloud.apply_resources import ApplyResources, RateLimiter, run_pool
+from novaclient import exceptions as nova_exceptions
 
 class TestApplyResources(unittest.TestCase):
     server_data = [('foo1_abc123', '93138146-2275-4e18-b41e-3957aa13e73a'),
@@ -131,20 +137,28 @@ class TestApplyResources(unittest.TestCase):
             create_server.side_effect = fake_create_server
             self.add_floating_ip_called = False
 
-            def server_get(id):
-                mm = mock.MagicMock()
-                if status[id]:
-                    mm.status = status[id].pop()
-                    mm.add_floating_ip.side_effect = Exception
-                else:
-                    def add_floating_ip(ip):
-                        self.assertEquals(ip, '1.2.3.4')
-                        self.add_floating_ip_called = True
+            def add_floating_ip(ip):
+                self.assertEquals(ip, '1.2.3.4')
+                self.add_floating_ip_called = True
 
-                    mm.add_floating_ip.side_effect = add_floating_ip
-                return mm
+            last_status = {}
+            def server_list(detailed, search_opts):
+                self.assertTrue(detailed)
+                listed = []
+                for id in status:
+                    mm = mock.MagicMock()
+                    mm.configure_mock(id=id, name='server%d' % id)
+                    if status[id]:
+                        last_status[id] = status[id].pop()
+                    mm.status = last_status[id]
+                    if status[id]:
+                        mm.add_floating_ip.side_effect = Exception
+                    else:
+                        mm.add_floating_ip.side_effect = add_floating_ip
+                    listed.append(mm)
+                return listed
 
-            get_nova_client.return_value.servers.get.side_effect = server_get
+            get_nova_client.return_value.servers.list.side_effect = server_list
             get_nova_client.return_value.floating_ips.create.return_value.ip = '1.2.3.4'
 
             file_mock.side_effect = lambda f: StringIO.StringIO('test user data')
@@ -164,3 +178,347 @@ class TestApplyResources(unittest.TestCase):
             for s in status.values():
                 self.assertEquals(s, [], 'create_servers stopped polling before server left BUILD state')
             self.assertTrue(self.add_floating_ip_called)
+            self.assertFalse(get_nova_client.return_value.servers.get.called)
+            self.assertEquals(sleep.call_args_list, [mock.call(1)] * 3)
+
+    def fake_servers(self, nova_client, statuses):
+        """
+        Make nova_client.servers.list return servers named after and with
+        the ids of the keys of statuses, going through their states in turn
+        """
+        def server_list(detailed, search_opts):
+            listed = []
+            for id, states in sorted(statuses.items()):
+                server = mock.Mock()
+                server.configure_mock(id=id, name=id, status=states[0],
+                                      fault={'message': 'No valid host was found'})
+                if len(states) > 1:
+                    states.pop(0)
+                listed.append(server)
+            return listed
+        nova_client.servers.list.side_effect = server_list
+
+    def test_wait_for_servers(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, get_nova_client):
+            nova_client = get_nova_client.return_value
+            self.fake_servers(nova_client, {'foo1_abc': ['BUILD'] * 5 + ['ERROR'],
+                                            'foo2_abc': ['BUILD', 'ACTIVE'],
+                                            'bar1_xyz': ['ACTIVE']})
+            built = apply_resources.wait_for_servers(['foo1_abc', 'foo2_abc'], project_tag='abc')
+            self.assertEquals(dict((id, s.status) for id, s in built.items()),
+                              {'foo1_abc': 'ERROR', 'foo2_abc': 'ACTIVE'})
+            nova_client.servers.list.assert_called_with(detailed=True,
+                                                        search_opts={'name': '_abc$'})
+            # backs off while nothing changes
+            self.assertEquals(sleep.call_args_list,
+                              [mock.call(1), mock.call(1), mock.call(1), mock.call(2),
+                               mock.call(4), mock.call(8)])
+
+    def test_project_search_opts(self):
+        apply_resources = ApplyResources()
+        self.assertEquals(apply_resources.project_search_opts('abc'), {'name': '_abc$'})
+        self.assertEquals(apply_resources.project_search_opts('v1.2+rc(1)'),
+                          {'name': '_v1\\.2\\+rc\\(1\\)$'})
+        self.assertEquals(apply_resources.project_search_opts(None), {})
+
+    def test_wait_for_servers_missing(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, get_nova_client):
+            nova_client = get_nova_client.return_value
+            self.fake_servers(nova_client, {'foo1_abc': ['BUILD', 'BUILD', 'ACTIVE']})
+            renamed = mock.Mock()
+            renamed.configure_mock(id='foo2_abc', name='foo2_renamed', status='ACTIVE')
+
+            def get(server_id):
+                if server_id == 'foo2_abc':
+                    return renamed
+                raise nova_exceptions.NotFound(404)
+            nova_client.servers.get.side_effect = get
+
+            built = apply_resources.wait_for_servers(['foo1_abc', 'foo2_abc', 'foo3_abc'],
+                                                     project_tag='abc')
+            self.assertEquals(dict((id, s.status) for id, s in built.items()),
+                              {'foo1_abc': 'ACTIVE', 'foo2_abc': 'ACTIVE'})
+            self.assertEquals(nova_client.servers.get.call_args_list,
+                              [mock.call('foo2_abc'), mock.call('foo3_abc')])
+
+    def test_create_servers_timeout(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('__builtin__.file'),
+               mock.patch('time.sleep'),
+               mock.patch('time.time'),
+               mock.patch.object(apply_resources, 'create_server'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (file_mock, sleep, time, create_server, get_nova_client):
+            nova_client = get_nova_client.return_value
+            create_server.side_effect = lambda userdata, key_name, name, **kwargs: name
+            self.fake_servers(nova_client, {'foo1': ['BUILD'], 'foo2': ['ACTIVE']})
+            time.side_effect = itertools.count(0, 10)
+            with self.assertRaises(Exception) as cm:
+                apply_resources.create_servers([{'name': 'foo1', 'assign_floating_ip': True},
+                                                {'name': 'foo2'}],
+                                               'somefile', timeout=35)
+            self.assertEquals(str(cm.exception), 'Failed to build: foo1')
+            self.assertEquals(nova_client.servers.list.call_count, 3)
+            self.assertFalse(nova_client.floating_ips.create.called)
+
+    def test_create_servers_error(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('__builtin__.file'),
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'create_server'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (file_mock, sleep, create_server, get_nova_client):
+            nova_client = get_nova_client.return_value
+            create_server.side_effect = lambda userdata, key_name, name, **kwargs: name
+            self.fake_servers(nova_client, {'foo1': ['BUILD', 'ERROR'],
+                                            'foo2': ['BUILD', 'ACTIVE']})
+            self.assertRaises(Exception, apply_resources.create_servers,
+                              [{'name': 'foo1', 'assign_floating_ip': True}, {'name': 'foo2'}],
+                              'somefile')
+            self.assertFalse(nova_client.floating_ips.create.called)
+
+    def test_create_servers_concurrently(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('__builtin__.file'),
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'create_server'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (file_mock, sleep, create_server, get_nova_client):
+            create_server.side_effect = lambda userdata, key_name, name, **kwargs: name
+            self.fake_servers(get_nova_client.return_value,
+                              dict(('foo%d' % i, ['ACTIVE']) for i in range(10)))
+            get_nova_client.return_value.floating_ips.create.return_value.ip = '1.2.3.4'
+            file_mock.side_effect = lambda f: StringIO.StringIO('test user data')
+
+            servers = [{'name': 'foo%d' % i} for i in range(10)]
+            servers[7]['assign_floating_ip'] = True
+            apply_resources.create_servers(servers, 'somefile', 'somekey',
+                                           concurrency=4, rate_limit=100)
+
+            self.assertEquals(sorted(c[1]['name'] for c in create_server.call_args_list),
+                              sorted(s['name'] for s in servers))
+            get_nova_client.return_value.floating_ips.create.assert_called_once_with()
+
+    def test_delete_servers(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, get_nova_client):
+            nova_client = get_nova_client.return_value
+            self.fake_server_data(nova_client)
+            ip = mock.Mock()
+            ip.configure_mock(instance_id='26af0276-83e1-4b68-870e-ff3250be8e8f', ip='1.2.3.4')
+            other_ip = mock.Mock(instance_id='something-else')
+            nova_client.floating_ips.list.return_value = [ip, other_ip]
+            servers = nova_client.servers.list.return_value
+
+            apply_resources.delete_servers('abc124', concurrency=4)
+
+            for server in servers:
+                self.assertEquals(server.delete.called, server.name == 'foo2_abc124')
+            servers[1].remove_floating_ip.assert_called_once_with('1.2.3.4')
+            ip.delete.assert_called_once_with()
+            self.assertFalse(other_ip.delete.called)
+            self.assertFalse(nova_client.servers.get.called)
+            self.assertFalse(sleep.called)
+
+    def test_delete_servers_wait(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, get_nova_client):
+            nova_client = get_nova_client.return_value
+            self.fake_server_data(nova_client)
+            nova_client.floating_ips.list.return_value = []
+            servers = nova_client.servers.list.return_value
+            # still listed twice after the delete, then gone
+            nova_client.servers.list.side_effect = [servers, servers, servers, []]
+
+            apply_resources.delete_servers('abc123', wait=True)
+
+            self.assertTrue(servers[0].delete.called)
+            self.assertEquals(sleep.call_args_list, [mock.call(1), mock.call(2), mock.call(4)])
+            nova_client.servers.list.assert_called_with(detailed=True,
+                                                        search_opts={'name': '_abc123$'})
+
+    def test_wait_for_deletion_timeout(self):
+        apply_resources = ApplyResources()
+        with nested(
+               mock.patch('time.sleep'),
+               mock.patch('time.time'),
+               mock.patch.object(apply_resources, 'get_nova_client')
+            ) as (sleep, time, get_nova_client):
+            nova_client = get_nova_client.return_value
+            self.fake_servers(nova_client, {'foo1_abc': ['ACTIVE', 'DELETED'],
+                                            'foo2_abc': ['ERROR']})
+            time.side_effect = itertools.count(0, 10)
+            with self.assertRaises(Exception) as cm:
+                apply_resources.wait_for_deletion(['foo1_abc', 'foo2_abc'], 'abc', timeout=25)
+            self.assertEquals(str(cm.exception),
+                              'Servers not deleted: foo1_abc (foo1_abc): DELETED, '
+                              'foo2_abc (foo2_abc): ERROR')
+
+    def test_ssh_config(self):
+        apply_resources = ApplyResources()
+        with mock.patch.object(apply_resources, 'get_nova_client') as get_nova_client:
+            def fake_server(name, networks):
+                s = mock.Mock()
+                s.configure_mock(name=name, networks=networks)
+                return s
+            nova_client = get_nova_client.return_value
+            nova_client.servers.list.return_value = [
+                fake_server('gw1_abc', {'private': ['10.0.0.2', '8.8.4.4']}),
+                fake_server('db1_abc', {'private': ['10.0.0.3']}),
+                fake_server('db1_abc', {'private': ['10.0.0.9']}),
+                fake_server('other', {'private': ['10.0.0.4']})]
+
+            config = apply_resources.ssh_config([{'name': 'gw1_abc', 'assign_floating_ip': True},
+                                                 {'name': 'db1_abc'}])
+            proxy = ('    ProxyCommand ssh -o StrictHostKeyChecking=no -o '
+                     'UserKnownHostsFile=/dev/null %r@8.8.4.4 nc %h %p\n')
+            self.assertEquals(config,
+                              'StrictHostKeyChecking no\n'
+                              'UserKnownHostsFile /dev/null\n'
+                              '\n'
+                              'Host gw1_abc\n'
+                              '    HostName 8.8.4.4\n'
+                              '\n'
+                              'Host db1_abc\n'
+                              '    HostName 10.0.0.3\n' + proxy +
+                              '\n')
+            self.assertEquals(nova_client.servers.list.call_count, 1)
+            self.assertRaises(Exception, apply_resources.ssh_config, [{'name': 'missing'}])
+
+            # nothing is generated when a server is missing, even a later one
+            config = apply_resources.iter_ssh_config([{'name': 'gw1_abc'}, {'name': 'missing'},
+                                                      {'name': 'gone'}])
+            with self.assertRaises(Exception) as cm:
+                next(config)
+            self.assertEquals(str(cm.exception), 'Server not found: missing, gone')
+
+    def test_create_server_lookups(self):
+        apply_resources = ApplyResources()
+        with nested(mock.patch.object(apply_resources, 'get_nova_client'),
+                    mock.patch('jiocloud.apply_resources.nova_utils.find_resource')
+                    ) as (get_nova_client, find_resource):
+            nova_client = get_nova_client.return_value
+            find_resource.side_effect = lambda manager, name: mock.Mock(id=name + '-id')
+            net_id = '381877b2-12c5-4831-95ed-1d7518bb7e8c'
+            for name in ('foo1', 'foo2'):
+                apply_resources.create_server(None, 'somekey', name, 'm1.small', 'trusty',
+                                              networks=[net_id, 'private'])
+            self.assertEquals(find_resource.call_args_list,
+                              [mock.call(nova_client.networks, 'private'),
+                               mock.call(nova_client.images, 'trusty'),
+                               mock.call(nova_client.flavors, 'm1.small')])
+            nova_client.servers.create.assert_called_with(
+                name='foo2', image='trusty-id', flavor='m1.small-id',
+                nics=[{'net-id': net_id}, {'net-id': 'private-id'}],
+                userdata=None, key_name='somekey', config_drive=False)
+
+    def test_resolve_all(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_path = os.path.join(tmpdir, 'lookups')
+        servers = [{'name': 'foo1', 'image': 'trusty', 'flavor': 'm1.small'},
+                   {'name': 'foo2', 'image': 'trusty', 'flavor': 'm1.large',
+                    'networks': ['private']}]
+
+        apply_resources = ApplyResources(cache_path, lookup_cache_ttl=60)
+        with nested(mock.patch.object(apply_resources, 'get_nova_client'),
+                    mock.patch('jiocloud.apply_resources.nova_utils.find_resource'),
+                    mock.patch('time.time')
+                    ) as (get_nova_client, find_resource, time):
+            time.return_value = 1000.0
+            find_resource.side_effect = lambda manager, name: mock.Mock(id=name + '-id')
+            apply_resources.resolve_all(servers, concurrency=2)
+            self.assertEquals(sorted(c[0][1] for c in find_resource.call_args_list),
+                              ['m1.large', 'm1.small', 'private', 'trusty'])
+            self.assertEquals(apply_resources.lookup('image', 'trusty'), 'trusty-id')
+            self.assertEquals(find_resource.call_count, 4)
+            with open(cache_path) as fp:
+                cache = json.load(fp)
+            self.assertEquals(cache['lookups']['flavor:m1.large'], ['m1.large-id', 1000.0])
+            self.assertEquals(cache['cloud'], {'auth_url': 'http://example.com/',
+                                               'region_name': 'region_name',
+                                               'project_id': 'tenant_name'})
+
+            # a later run reuses the ids while they are fresh
+            find_resource.reset_mock()
+            time.return_value = 1050.0
+            apply_resources = ApplyResources(cache_path, lookup_cache_ttl=60)
+            apply_resources.resolve_all(servers)
+            self.assertFalse(find_resource.called)
+
+            # but not against another region
+            os.environ['OS_REGION_NAME'] = 'other_region'
+            self.assertEquals(ApplyResources(cache_path, lookup_cache_ttl=60)._lookups, {})
+            os.environ['OS_REGION_NAME'] = 'region_name'
+
+            time.return_value = 1070.0
+            apply_resources = ApplyResources(cache_path, lookup_cache_ttl=60)
+            with mock.patch.object(apply_resources, 'get_nova_client'):
+                apply_resources.resolve_all(servers)
+            self.assertEquals(find_resource.call_count, 4)
+
+    def test_run_pool(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def func(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            if len(peak) >= 3:
+                release.set()
+            release.wait(5)
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        self.assertEquals(run_pool(func, range(8), concurrency=3), [x * 2 for x in range(8)])
+        self.assertEquals(max(peak), 3)
+        self.assertEquals(run_pool(lambda x: x, []), [])
+
+    def test_run_pool_error(self):
+        calls = []
+
+        def func(item):
+            calls.append(item)
+            if item == 2:
+                raise ValueError(item)
+            return item
+
+        self.assertRaises(ValueError, run_pool, func, range(10))
+        self.assertEquals(calls, [0, 1, 2])
+        del calls[:]
+        self.assertRaises(ValueError, run_pool, func, range(10), concurrency=2)
+        self.assertTrue(len(calls) < 10)
+
+    def test_rate_limiter(self):
+        with nested(mock.patch('time.time'),
+                    mock.patch('time.sleep')) as (time, sleep):
+            time.return_value = 100.0
+            limiter = RateLimiter(4)
+            for i in range(3):
+                limiter.wait()
+            self.assertEquals(sleep.call_args_list, [mock.call(0.25), mock.call(0.5)])
+
+            sleep.reset_mock()
+            RateLimiter().wait()
+            self.assertFalse(sleep.called)
@@ -0,0 +1,83 @@
+#    Copyright Reliance Jio Infocomm, Ltd.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""
+How DeploymentOrchestrator scales with the size of the fleet, measured
+against a FakeConsul seeded with many hosts spread over several versions.
+
+By default only a small fleet is used, which checks the request counts.
+Set JORC_BENCHMARK=1 to also run with 1k, 10k and 50k hosts, and use
+nosetests -s to see the report.
+"""
+import os
+import time
+import unittest
+
+from jiocloud.orchestrate import ConsulMetrics, DeploymentOrchestrator
+from fake_consul import FakeConsul
+
+VERSIONS = ['v10', 'v11', 'v12']
+
+SIZES = [100]
+if os.environ.get('JORC_BENCHMARK'):
+    SIZES += [1000, 10000, 50000]
+
+COMMANDS = [
+    ('running_versions', lambda do: do.running_versions()),
+    ('hosts_at_version', lambda do: do.hosts_at_version('v11')),
+    ('update_own_info', lambda do: do.update_own_info('host1', version='v12')),
+    ('check_single_version', lambda do: do.check_single_version('v12')),
+    ('get_failures', lambda do: do.get_failures()),
+]
+
+# Requests each command may make, whatever the size of the fleet
+EXPECTED_REQUESTS = {'running_versions': 1,
+                     'hosts_at_version': 1,
+                     'update_own_info': 2,
+                     'check_single_version': 1,
+                     'get_failures': 1}
+
+
+class ScaleBenchmark(unittest.TestCase):
+    def measure(self, hosts):
+        consul = FakeConsul()
+        consul.seed(hosts, VERSIONS, current_version='v12', failing=hosts / 100)
+        port = consul.start()
+        try:
+            results = []
+            for name, command in COMMANDS:
+                do = DeploymentOrchestrator('127.0.0.1', port)
+                do.metrics = ConsulMetrics(name)
+                start = time.time()
+                command(do)
+                elapsed = time.time() - start
+                do.http.close()
+                stats = do.metrics.endpoints.values()
+                results.append((name, elapsed,
+                                sum(s['count'] for s in stats),
+                                sum(s['bytes'] for s in stats)))
+            return results
+        finally:
+            consul.stop()
+
+    def test_scale(self):
+        print
+        print '%8s  %-22s %12s %9s %12s' % ('hosts', 'command', 'latency(ms)',
+                                            'requests', 'bytes')
+        for hosts in SIZES:
+            for name, elapsed, requests, nbytes in self.measure(hosts):
+                print '%8d  %-22s %12.1f %9d %12d' % (hosts, name, elapsed * 1000,
+                                                      requests, nbytes)
+                self.assertEquals(requests, EXPECTED_REQUESTS[name],
+                                  '%s made %d requests with %d hosts' % (name, requests, hosts))
@@ -16,10 +16,18 @@
 import errno
 import mock
 import consulate
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
 import unittest
 import json
 from contextlib import nested
-from jiocloud.orchestrate import DeploymentOrchestrator
+from jiocloud import orchestrate, orchestrate_daemon
+from jiocloud.orchestrate import ConsulMetrics, DeploymentOrchestrator, HealthSummary
+from urllib3.exceptions import HTTPError
+from fake_consul import FakeConsul
 
 class OrchestrateTests(unittest.TestCase):
     def setUp(self, *args, **kwargs):
@@ -65,93 +73,334 @@ class OrchestrateTests(unittest.TestCase):
             self.assertTrue(self.do.verify_hosts('', ['cp1', 'ctrl1']))
             self.assertFalse(self.do.verify_hosts('', ['cp2', 'ctrl1']))
 
-    def test_hosts_at_version_none(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.side_effect = KeyError
+    def test_version_census(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 12, ['running_version/v10/',
+                                              'running_version/v11/node1',
+                                              'running_version/v11/node2',
+                                              'running_version/v12/node3'])
+            self.assertEquals(self.do.version_census(),
+                              {'v10': set(),
+                               'v11': set(['node1', 'node2']),
+                               'v12': set(['node3'])})
+            request.assert_called_once_with('GET', 'kv/running_version/', {'keys': None})
 
-            self.assertEquals(self.do.hosts_at_version('foo'), [])
+    def test_version_census_none(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (404, 12, None)
+            self.assertEquals(self.do.version_census(), {})
+
+    def test_hosts_at_version_none(self):
+        with mock.patch.object(self.do, 'version_census') as version_census:
+            version_census.return_value = {}
+            self.assertEquals(self.do.hosts_at_version('foo'), set())
 
     def test_hosts_at_version_none_but_dir_exists(self):
-        with mock.patch.object(self.do, '_consul') as consul:
-            consul.return_value.kv.find.return_value = [
-                '/running_version/foo/'
+        with mock.patch.object(self.do, '_kv_keys') as kv_keys:
+            kv_keys.return_value = [
+                'running_version/foo/'
                 ]
             self.assertEquals(self.do.hosts_at_version('foo'), set([]))
 
     def test_hosts_at_version(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.return_value = [
-                '/running_version/foo/node1',
-                '/running_version/foo/node2'
+        with mock.patch.object(self.do, '_kv_keys') as kv_keys:
+            kv_keys.return_value = [
+                'running_version/foo/node1',
+                'running_version/foo/node2',
+                'running_version/bar/node3'
                 ]
             self.assertEquals(self.do.hosts_at_version('foo'), set(['node1', 'node2']))
-            consul.return_value.kv.find.assert_called_with('/running_version/foo')
+            kv_keys.assert_called_with('running_version/')
 
     def test_running_versions(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.return_value = [
-                'running_version/v10',
-                'running_version/v11',
-                'running_version/v12'
+        with mock.patch.object(self.do, '_kv_keys') as kv_keys:
+            kv_keys.return_value = [
+                'running_version/v10/',
+                'running_version/v11/',
+                'running_version/v12/node1'
                 ]
             self.assertEquals(self.do.running_versions(),
                               set(['v10', 'v11', 'v12']))
 
     def test_running_versions_none(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.find.return_value = [
-                'running_version',
+        with mock.patch.object(self.do, '_kv_keys') as kv_keys:
+            kv_keys.return_value = [
+                'running_version/',
                 ]
             self.assertEquals(self.do.running_versions(), set())
 
     def test_running_versions_none2(self):
-        with mock.patch.object(self.do, '_consul') as consul:
-            consul.read.side_effect = KeyError
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (404, 1, None)
             self.assertEquals(self.do.running_versions(), set())
 
+    def test_check_single_version_shares_census(self):
+        with mock.patch.object(self.do, 'version_census') as version_census:
+            census = {'v10': set(['node1']), 'v11': set(['node2'])}
+            self.assertFalse(self.do.check_single_version('v11', census=census))
+            self.assertTrue(self.do.verify_hosts('v11', ['node2'], census=census))
+            self.assertFalse(version_census.called)
+            census = {'v11': set(['node1', 'node2'])}
+            self.assertTrue(self.do.check_single_version('v11', census=census))
+
+    checks = [{'Node': 'node1', 'Name': 'puppet', 'Status': 'warning', 'Output': 'failed'},
+              {'Node': 'node1', 'Name': 'serf', 'Status': 'passing'},
+              {'Node': 'node2', 'Name': 'validation', 'Status': 'passing'},
+              {'Node': 'node2', 'Name': 'nova', 'Status': 'critical'},
+              {'Node': 'node3', 'Name': 'disk', 'Status': 'warning'}]
+
+    def test_health_summary(self):
+        summary = HealthSummary(self.checks)
+        self.assertEquals([(x['Node'], x['Name']) for x in summary.failures],
+                          [('node1', 'puppet'), ('node2', 'nova')])
+        self.assertEquals([(x['Node'], x['Name']) for x in summary.warnings],
+                          [('node3', 'disk')])
+        self.assertEquals(summary.by_status, {'passing': 2, 'warning': 2, 'critical': 1})
+        self.assertEquals(summary.by_node['node2'], {'passing': 1, 'critical': 1})
+        self.assertEquals(summary.by_check['puppet'], {'warning': 1})
+        self.assertEquals(summary.as_dict()['failures'][0],
+                          {'node': 'node1', 'check': 'puppet',
+                           'status': 'warning', 'output': 'failed'})
+
     def test_get_failures_failing(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.get_value.health.state.return_value = [1,2]
-            self.assertTrue(self.do.get_failures())
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 1, self.checks)
+            self.assertFalse(self.do.get_failures())
+            request.assert_called_once_with('GET', 'health/state/any', index=None, wait=None)
+
+    def test_get_failures_warnings(self):
+        summary = HealthSummary([self.checks[1], self.checks[4]])
+        self.assertTrue(self.do.get_failures(summary=summary))
+        self.assertFalse(self.do.get_failures(show_warnings=True, summary=summary))
 
     def test_get_failures_passing(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.get_value.health.state.return_value = []
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 1, [])
             self.assertTrue(self.do.get_failures())
 
 
 #    def test_update_own_status(self):
 
+    def test_own_status(self):
+        self.assertEquals(self.do.own_status('puppet', 0), 'pass')
+        self.assertEquals(self.do.own_status('puppet', '2'), 'pass')
+        self.assertEquals(self.do.own_status('puppet', 4), 'warn')
+        self.assertEquals(self.do.own_status('puppet', -1), 'warn')
+        self.assertEquals(self.do.own_status('validation', 0), 'pass')
+        self.assertEquals(self.do.own_status('validation', 1), 'warn')
+        self.assertRaises(Exception, self.do.own_status, 'disk', 0)
+
+    def test_check_ttl(self):
+        with mock.patch.object(self.do, '_request') as request:
+            self.do.check_ttl('puppet', 'warn')
+            request.assert_called_once_with('PUT', 'agent/check/warn/puppet')
+
     def test_update_own_info(self):
-        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock),
+        with nested(mock.patch.object(self.do, '_request'),
+                    mock.patch('time.time')
+          ) as (request, time):
+            time.return_value = 12345678
+            request.side_effect = [(200, 5, [{'Key': 'host_version/testhost',
+                                              'Value': 'djEy'}]),
+                                   (200, 6, {'Results': [], 'Errors': None})]
+
+            self.do.update_own_info(hostname='testhost',
+                                    version='v13')
+            self.assertEquals(request.call_args_list[0],
+                              mock.call('GET', 'kv/host_version/testhost', index=None, wait=None))
+            self.assertEquals(request.call_args_list[1][0][:2], ('PUT', 'txn'))
+            self.assertEquals(json.loads(request.call_args_list[1][1]['body']),
+                              [{'KV': {'Verb': 'set',
+                                       'Key': 'running_version/v13/testhost',
+                                       'Value': 'MTIzNDU2Nzg='}},
+                               {'KV': {'Verb': 'set',
+                                       'Key': 'host_version/testhost',
+                                       'Value': 'djEz'}},
+                               {'KV': {'Verb': 'delete',
+                                       'Key': 'running_version/v12/testhost'}}])
+
+    def test_update_own_info_unindexed(self):
+        with nested(mock.patch.object(self.do, '_request'),
                     mock.patch('time.time')
-          ) as (consul, time):
+          ) as (request, time):
             time.return_value = 12345678
+            request.side_effect = [(404, 5, None),
+                                   (200, 5, ['running_version/v12/testhost',
+                                             'running_version/v12/otherhost',
+                                             'running_version/v13/',
+                                             'running_version/v13/testhost2',
+                                             'running_version/v11/testhost']),
+                                   (200, 6, {'Results': [], 'Errors': None})]
 
             self.do.update_own_info(hostname='testhost',
                                     version='v13')
-            expected_calls = [mock.call('/running_version/v13/testhost',
-                                        '12345678')]
-            self.assertEquals(consul.return_value.kv.set.call_args_list, expected_calls)
+            self.assertEquals(request.call_args_list[1],
+                              mock.call('GET', 'kv/running_version/', {'keys': None}))
+            self.assertEquals([op['KV']['Key'] for op in json.loads(request.call_args_list[2][1]['body'])
+                               if op['KV']['Verb'] == 'delete'],
+                              ['running_version/v11/testhost',
+                               'running_version/v12/testhost'])
+
+    def test_update_own_info_same_version(self):
+        with nested(mock.patch.object(self.do, 'host_version'),
+                    mock.patch.object(self.do, '_txn')
+          ) as (host_version, txn):
+            host_version.return_value = 'v13'
+            self.do.update_own_info(hostname='testhost', version='v13')
+            self.assertEquals([op['KV']['Verb'] for op in txn.call_args[0][0]],
+                              ['set', 'set'])
+
+    def test_backfill_host_versions(self):
+        with nested(mock.patch.object(self.do, '_kv_find'),
+                    mock.patch.object(self.do, '_txn')
+          ) as (kv_find, txn):
+            kv_find.return_value = {'running_version/v12/': None,
+                                    'running_version/v12/host1': '100.5',
+                                    'running_version/v13/host1': '200.5',
+                                    'running_version/v12/host2': '100.5'}
+            self.assertEquals(self.do.backfill_host_versions(dry_run=True),
+                              {'host1': 'v13', 'host2': 'v12'})
+            self.assertFalse(txn.called)
+
+            self.do.backfill_host_versions()
+            txn.assert_called_once_with([self.do._kv_op('set', 'host_version/host1', 'v13'),
+                                         self.do._kv_op('set', 'host_version/host2', 'v12')],
+                                        ordered=False)
+
+    def test_gc(self):
+        with nested(mock.patch.object(self.do, 'catalog_nodes'),
+                    mock.patch.object(self.do, '_kv_find'),
+                    mock.patch.object(self.do, '_txn'),
+                    mock.patch('time.time')
+          ) as (catalog_nodes, kv_find, txn, time):
+            time.return_value = 100000.0
+            catalog_nodes.return_value = set(['host1', 'host2'])
+            entries = {'running_version/v12/': (None, 5),
+                       # superseded by v13
+                       'running_version/v12/host1': ('100.5', 6),
+                       'running_version/v13/host1': ('200.5', 7),
+                       'running_version/v13/host2': ('200.5', 8),
+                       # gone from the catalog
+                       'running_version/v11/host3': ('50.5', 9),
+                       'running_version/v12/host3': ('garbage', 10),
+                       # gone, but registered too recently
+                       'running_version/v13/host4': ('99000.0', 11),
+                       'host_version/host3': ('v12', 12),
+                       'host_version/host4': ('v13', 13)}
+            kv_find.side_effect = lambda prefix, indexes: dict(
+                (key, entry) for key, entry in entries.iteritems() if key.startswith(prefix))
+            expected = ['running_version/v11/host3',
+                        'running_version/v12/host1',
+                        'running_version/v12/host3',
+                        'host_version/host3']
+            self.assertEquals(self.do.gc(min_age=3600, dry_run=True), expected)
+            self.assertFalse(txn.called)
+
+            self.assertEquals(self.do.gc(min_age=3600), expected)
+            txn.assert_called_once_with([self.do._kv_op('delete-cas', key, index=entries[key][1])
+                                         for key in expected],
+                                        ordered=False)
+
+            txn.reset_mock()
+            self.assertEquals(self.do.gc(min_age=0)[-2:],
+                              ['host_version/host3', 'host_version/host4'])
+
+    def test_gc_keeps_rewritten_entries(self):
+        consul = FakeConsul()
+        consul.seed(2, ['v12'])
+        consul.kv['running_version/v11/host1'] = consul._entry('running_version/v11/host1', '50.5')
+        consul.nodes.discard('host1')
+        port = consul.start()
+        self.addCleanup(consul.stop)
+        do = DeploymentOrchestrator('127.0.0.1', port)
+        self.addCleanup(do.http.close)
+
+        kv_find = do._kv_find
+
+        def kv_find_then_return(prefix, indexes=False):
+            found = kv_find(prefix, indexes)
+            if prefix == 'host_version/':
+                # host1 comes back while gc runs
+                consul.set('host_version/host1', 'v13')
+            return found
+
+        with mock.patch.object(do, '_kv_find', side_effect=kv_find_then_return):
+            self.assertRaises(HTTPError, do.gc, min_age=0)
+        self.assertEquals(sorted(k for k in consul.kv if k.endswith('host1')),
+                          ['host_version/host1',
+                           'running_version/v11/host1',
+                           'running_version/v12/host1'])
+        self.assertEquals(consul.kv['host_version/host1']['Value'], 'v13')
+
+        # the next run sees host1's new entry
+        do.gc(min_age=0)
+        self.assertEquals(sorted(k for k in consul.kv if k.endswith('host1')), [])
+
+    def test_catalog_nodes(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 5, [{'Node': 'host1', 'Address': '10.0.0.1'},
+                                             {'Node': 'host2', 'Address': '10.0.0.2'}])
+            self.assertEquals(self.do.catalog_nodes(), set(['host1', 'host2']))
+            request.assert_called_once_with('GET', 'catalog/nodes')
 
     def test_update_own_info_no_version_noop(self):
-        with nested(mock.patch.object(self.do, '_consul'),
+        with nested(mock.patch.object(self.do, '_request'),
                     mock.patch.object(self.do, 'local_version')
-                    ) as (consul, local_version):
+                    ) as (request, local_version):
             local_version.return_value = None
 
             self.do.update_own_info(hostname='testhost')
 
-            self.assertEquals(consul.write.call_args_list, [])
+            self.assertEquals(request.call_args_list, [])
 
     def test_update_own_info_defaults_to_local_version(self):
-        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock),
+        with nested(mock.patch.object(self.do, 'host_version'),
+                    mock.patch.object(self.do, '_txn'),
                     mock.patch.object(self.do, 'local_version')
-          ) as (consul, local_version):
+          ) as (host_version, txn, local_version):
+            host_version.return_value = 'v673'
             local_version.return_value = 'v674'
             self.do.update_own_info(hostname='testhost')
-            self.assertEquals(consul.return_value.kv.set.call_args[0][0],
-                              '/running_version/v674/testhost')
+            self.assertEquals(txn.call_args[0][0][0]['KV']['Key'],
+                              'running_version/v674/testhost')
+
+    def test_txn_batches(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 1, {'Results': [], 'Errors': None})
+            self.do._txn([self.do._kv_op('delete', 'k%d' % i) for i in range(130)])
+            self.assertEquals([len(json.loads(c[1]['body'])) for c in request.call_args_list],
+                              [64, 64, 2])
+
+    def test_txn_unordered(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 1, {'Results': [], 'Errors': None})
+            self.do._txn([self.do._kv_op('delete', 'k%d' % i) for i in range(64 * 10)],
+                         ordered=False)
+            self.assertEquals(len(request.call_args_list), 10)
+            keys = sorted(op['KV']['Key'] for c in request.call_args_list
+                          for op in json.loads(c[1]['body']))
+            self.assertEquals(keys, sorted('k%d' % i for i in range(64 * 10)))
+
+    def test_concurrently(self):
+        started = threading.Event()
+
+        def first():
+            # only returns if the second call runs at the same time
+            started.wait(5)
+            return started.is_set()
+
+        self.assertEquals(orchestrate.concurrently(first, started.set, lambda: 3),
+                          [True, None, 3])
+        self.assertEquals(orchestrate.concurrently(), [])
+
+        def fail():
+            raise KeyError('x')
+        self.assertRaises(KeyError, orchestrate.concurrently, lambda: 1, fail)
+
+    def test_txn_rollback(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (409, 1, {'Results': None, 'Errors': [{'OpIndex': 0}]})
+            self.assertRaises(Exception, self.do._txn, [self.do._kv_op('delete', 'k')])
 
     def test_ping_succesful(self):
         with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
@@ -169,10 +418,210 @@ class OrchestrateTests(unittest.TestCase):
             self.assertFalse(self.do.ping())
 
     def test_current_version(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
-            consul.return_value.kv.get.return_value = 'v673 '
+        with mock.patch.object(self.do, '_kv_get') as kv_get:
+            kv_get.return_value = ({'Value': 'v673 '}, 12)
             self.assertEquals(self.do.current_version(), 'v673')
-            consul.return_value.kv.get.assert_called_with('/current_version')
+            kv_get.assert_called_with('/current_version')
+
+            kv_get.return_value = (None, 12)
+            self.assertEquals(self.do.current_version(), None)
+
+    def test_current_version_rollout(self):
+        with mock.patch.object(self.do, '_kv_get') as kv_get:
+            targets = {'/current_version': {'Value': 'v1', 'Flags': 1},
+                       '/target_version/node1': {'Value': 'v2'}}
+            kv_get.side_effect = lambda key: (targets.get(key), 5)
+            self.assertEquals(self.do.current_version(), 'v1')
+            self.assertEquals(self.do.current_version('node1'), 'v2')
+            self.assertEquals(self.do.current_version('node2'), 'v1')
+
+            targets['/current_version']['Flags'] = 0
+            self.assertEquals(self.do.current_version('node1'), 'v1')
+
+    def test_watch_fleet(self):
+        first_seen = threading.Event()
+        done = threading.Event()
+
+        def census_snapshot(index=None, wait=None):
+            if index is None:
+                return {'v1': set(['h1'])}, 10
+            first_seen.wait(5)
+            if done.is_set():
+                raise IOError
+            # the first blocking query returns with nothing new, the
+            # second with a change
+            if census_snapshot.calls:
+                done.set()
+                return {'v2': set(['h1'])}, 11
+            census_snapshot.calls += 1
+            return {'v1': set(['h1'])}, 10
+        census_snapshot.calls = 0
+
+        def health_snapshot(index=None, wait=None):
+            if index is None:
+                return HealthSummary([]), 20
+            done.wait(5)
+            raise IOError
+
+        with nested(mock.patch.object(self.do, 'census_snapshot'),
+                    mock.patch.object(self.do, 'health_snapshot')
+                    ) as (census, health):
+            census.side_effect = census_snapshot
+            health.side_effect = health_snapshot
+            fleet = self.do.watch_fleet(wait=5, timeout=5)
+            states = [next(fleet)]
+            first_seen.set()
+            states.append(next(fleet))
+            fleet.close()
+            self.assertEquals([c for c, h in states],
+                              [{'v1': set(['h1'])}, {'v2': set(['h1'])}])
+            self.assertEquals(census.call_args_list[:3],
+                              [mock.call(None, 5), mock.call(10, 5), mock.call(10, 5)])
+
+    def test_watch_fleet_timeout(self):
+        with nested(mock.patch.object(self.do, 'census_snapshot'),
+                    mock.patch.object(self.do, 'health_snapshot')
+                    ) as (census_snapshot, health_snapshot):
+            census_snapshot.return_value = ({}, 10)
+            health_snapshot.side_effect = IOError
+            self.assertEquals(list(self.do.watch_fleet(wait=1, timeout=0.1)), [])
+
+    def test_watch_fleet_interval(self):
+        with nested(mock.patch.object(self.do, 'census_snapshot'),
+                    mock.patch.object(self.do, 'health_snapshot')
+                    ) as (census_snapshot, health_snapshot):
+            census_snapshot.return_value = ({'v1': set(['h1'])}, 10)
+            health_snapshot.return_value = (HealthSummary([]), 20)
+            fleet = self.do.watch_fleet(wait=0.01, timeout=5, interval=0.01)
+            # nothing changes, but the state keeps coming
+            states = [next(fleet) for i in range(3)]
+            fleet.close()
+            self.assertEquals([c for c, h in states], [{'v1': set(['h1'])}] * 3)
+
+    def fake_fleet(self, *states):
+        def watch_fleet(wait=60, timeout=None, interval=None):
+            for state in states:
+                yield state
+        return watch_fleet
+
+    def test_wait_for_convergence(self):
+        healthy = HealthSummary([])
+        unhealthy = HealthSummary([{'Node': 'h2', 'Name': 'nova', 'Status': 'critical'}])
+        with nested(mock.patch.object(self.do, 'watch_fleet'),
+                    mock.patch.object(self.do, 'catalog_nodes'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                    ) as (watch_fleet, catalog_nodes, stdout):
+            # old is decommissioned, but its registration is still around
+            catalog_nodes.return_value = set(['h1', 'h2'])
+            watch_fleet.side_effect = self.fake_fleet(
+                ({'v1': set(['h1', 'h2']), 'v0': set(['old'])}, healthy),
+                ({'v1': set(['h1']), 'v2': set(['h2']), 'v0': set(['old'])}, unhealthy),
+                ({'v2': set(['h1', 'h2']), 'v0': set(['old'])}, unhealthy),
+                ({'v2': set(['h1', 'h2']), 'v0': set(['old'])}, healthy),
+                ({'v2': set(['h1', 'h2']), 'v0': set(['old'])}, unhealthy))
+            self.assertTrue(self.do.wait_for_convergence('v2', verbose=True))
+            watch_fleet.assert_called_once_with(60, 3600)
+            self.assertEquals(stdout.getvalue().splitlines(),
+                              ['0/2 hosts at v2, 0 failing',
+                               '1/2 hosts at v2, 1 failing',
+                               '2/2 hosts at v2, 1 failing',
+                               '2/2 hosts at v2, 0 failing'])
+
+    def test_wait_for_convergence_timeout(self):
+        unhealthy = HealthSummary([{'Node': 'h3', 'Name': 'nova', 'Status': 'critical'}])
+        with nested(mock.patch.object(self.do, 'watch_fleet'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                    ) as (watch_fleet, stdout):
+            watch_fleet.side_effect = self.fake_fleet(
+                ({'v1': set(['h1']), 'v2': set(['h2', 'h3'])}, unhealthy))
+            self.assertFalse(self.do.wait_for_convergence('v2', ['h1', 'h2', 'h3'],
+                                                          timeout=10, verbose=True))
+            watch_fleet.assert_called_once_with(60, 10)
+            self.assertEquals(stdout.getvalue().splitlines(),
+                              ['2/3 hosts at v2, 1 failing',
+                               'Waiting on: h1 h3'])
+
+    def test_rollout(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch.object(self.do, 'watch_fleet'),
+                    mock.patch.object(self.do, '_txn')
+                    ) as (kv_get, watch_fleet, txn):
+            kv_get.return_value = ({'Value': 'v1', 'Flags': 0}, 3)
+            healthy = HealthSummary([])
+            unhealthy = HealthSummary([{'Node': 'h2', 'Name': 'puppet', 'Status': 'warning'}])
+            watch_fleet.side_effect = self.fake_fleet(
+                ({'v1': set(['h1', 'h2', 'h3'])}, healthy),
+                ({'v1': set(['h3']), 'v2': set(['h1', 'h2'])}, unhealthy),
+                ({'v1': set(['h3']), 'v2': set(['h1', 'h2'])}, healthy),
+                ({'v2': set(['h1', 'h2', 'h3'])}, healthy))
+
+            self.assertTrue(self.do.rollout('v2', ['h1', 'h2', 'h3'], wave_size=2, wait=30))
+
+            watch_fleet.assert_called_once_with(30, None, 30)
+            self.assertEquals(txn.call_args_list, [
+                mock.call([self.do._kv_op('delete-tree', 'target_version/'),
+                           self.do._kv_op('set', 'target_version/h1', 'v2'),
+                           self.do._kv_op('set', 'target_version/h2', 'v2'),
+                           self.do._kv_op('set', 'current_version', 'v1', 1)]),
+                mock.call([self.do._kv_op('set', 'target_version/h3', 'v2'),
+                           self.do._kv_op('set', 'current_version', 'v1', 1)]),
+                mock.call([self.do._kv_op('set', 'current_version', 'v2'),
+                           self.do._kv_op('delete-tree', 'target_version/')])])
+
+    def test_rollout_concurrency(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch.object(self.do, 'watch_fleet'),
+                    mock.patch.object(self.do, '_txn'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                    ) as (kv_get, watch_fleet, txn, stdout):
+            kv_get.return_value = ({'Value': 'v1', 'Flags': 0}, 3)
+            healthy = HealthSummary([])
+            watch_fleet.side_effect = self.fake_fleet(
+                ({'v1': set(['h1', 'h2', 'h3'])}, healthy),
+                ({'v1': set(['h1']), 'v2': set(['h2', 'h3'])}, healthy))
+            self.assertFalse(self.do.rollout('v2', ['h1', 'h2', 'h3'], wave_size=1, concurrency=2))
+            # h2's wave finishing first frees a slot for h3's
+            self.assertEquals([c[0][0][-2]['KV']['Key'] for c in txn.call_args_list],
+                              ['target_version/h1', 'target_version/h2', 'target_version/h3'])
+            self.assertEquals(stdout.getvalue().splitlines(), ['Wave 1/3 waiting on: h1'])
+
+    def test_rollout_timeout(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch.object(self.do, 'watch_fleet'),
+                    mock.patch.object(self.do, '_txn')
+                    ) as (kv_get, watch_fleet, txn):
+            kv_get.return_value = ({'Value': 'v1', 'Flags': 0}, 3)
+            watch_fleet.side_effect = self.fake_fleet(({'v1': set(['h1'])}, HealthSummary([])))
+            self.assertFalse(self.do.rollout('v2', ['h1'], timeout=60))
+            watch_fleet.assert_called_once_with(60, 60, 60)
+            self.assertEquals(len(txn.call_args_list), 1)
+
+    def test_rollout_wave_timeout(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch.object(self.do, 'version_census'),
+                    mock.patch.object(self.do, 'catalog_nodes'),
+                    mock.patch.object(self.do, 'watch_fleet'),
+                    mock.patch.object(self.do, '_txn'),
+                    mock.patch('time.time'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                    ) as (kv_get, version_census, catalog_nodes, watch_fleet, txn, time, stdout):
+            kv_get.return_value = ({'Value': 'v1', 'Flags': 0}, 3)
+            # old has left the catalog, h2 never moves
+            version_census.return_value = {'v1': set(['h1', 'h2']), 'v0': set(['old'])}
+            catalog_nodes.return_value = set(['h1', 'h2'])
+            state = ({'v1': set(['h2']), 'v2': set(['h1'])}, HealthSummary([]))
+            watch_fleet.side_effect = self.fake_fleet(state, state, state)
+            time.side_effect = [100, 200, 700, 800]
+
+            self.assertFalse(self.do.rollout('v2', wait=30, wave_timeout=600))
+
+            watch_fleet.assert_called_once_with(30, None, 30)
+            self.assertEquals(txn.call_args_list, [
+                mock.call([self.do._kv_op('delete-tree', 'target_version/'),
+                           self.do._kv_op('set', 'target_version/h1', 'v2'),
+                           self.do._kv_op('set', 'target_version/h2', 'v2'),
+                           self.do._kv_op('set', 'current_version', 'v1', 1)])])
+            self.assertEquals(stdout.getvalue().splitlines(), ['Wave 1/1 waiting on: h2'])
 
     def test_pending_update(self):
         with nested(
@@ -209,11 +658,709 @@ class OrchestrateTests(unittest.TestCase):
             self.assertEquals(self.do.pending_update(),
                               self.do.NO_CLUE_BUT_WERE_JUST_GETTING_STARTED)
 
+    def test_request(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value.status = 200
+            http.urlopen.return_value.data = '["a"]'
+            http.urlopen.return_value.getheader.return_value = '17'
+            self.assertEquals(self.do._request('GET', 'kv/foo/', {'keys': None, 'separator': '/'}),
+                              (200, 17, ['a']))
+            http.urlopen.assert_called_with('GET', '/v1/kv/foo/?keys&separator=%2F', body=None,
+                                            timeout=None, retries=False)
+
+            http.urlopen.return_value.status = 500
+            self.assertRaises(Exception, self.do._request, 'GET', 'kv/foo')
+
+    def test_request_metrics(self):
+        with nested(mock.patch.object(self.do, '_http'),
+                    mock.patch('time.time')
+                    ) as (http, time):
+            time.side_effect = [10, 10.02, 20, 20.5]
+            http.urlopen.return_value.status = 404
+            http.urlopen.return_value.data = ''
+            self.do._request('GET', 'kv/host_version/node1')
+            http.urlopen.side_effect = IOError
+            self.assertRaises(IOError, self.do._request, 'GET', 'kv/host_version/node2')
+            stats = self.do.metrics.endpoints['GET kv/host_version']
+            self.assertEquals((stats['count'], stats['errors'], stats['bytes']), (2, 1, 0))
+            self.assertAlmostEquals(stats['max'], 0.5)
+
+    def test_consulate_metrics(self):
+        with mock.patch('consulate.Consulate', create=True) as consulate_class:
+            consulate_class.return_value.agent.members.return_value = [{'Name': 'node1'}]
+            self.assertTrue(self.do.ping())
+            consulate_class.return_value.agent.members.assert_called_with()
+            self.assertEquals(self.do.metrics.endpoints['consulate agent.members']['count'], 1)
+
+    def test_request_blocking(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value.status = 200
+            http.urlopen.return_value.data = ''
+            self.do._request('GET', 'kv/foo', index=12, wait=160)
+            http.urlopen.assert_called_with('GET', '/v1/kv/foo?index=12&wait=160s', body=None,
+                                            timeout=175, retries=False)
+
+    def test_request_consistency(self):
+        do = DeploymentOrchestrator('somehost', 10000, consistency='stale')
+        with mock.patch.object(do, '_http') as http:
+            http.urlopen.return_value.status = 200
+            http.urlopen.return_value.data = ''
+            do._request('GET', 'health/state/any')
+            self.assertEquals(http.urlopen.call_args[0][1], '/v1/health/state/any?stale')
+            do._request('PUT', 'txn', body='[]')
+            self.assertEquals(http.urlopen.call_args[0][1], '/v1/txn')
+        self.assertRaises(ValueError, DeploymentOrchestrator, consistency='sloppy')
+
+    def test_snapshot(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value.status = 200
+            http.urlopen.return_value.data = '[{"Key": "current_version", "Value": "djEy"}]'
+            http.urlopen.return_value.getheader.return_value = '7'
+            with self.do.snapshot():
+                self.assertEquals(self.do._kv_get('current_version')[0]['Value'], 'v12')
+                self.assertEquals(self.do._kv_get('current_version'),
+                                  ({'Key': 'current_version', 'Value': 'v12'}, 7))
+                self.do._request('GET', 'health/state/any')
+                self.do._request('GET', 'health/state/any')
+                self.assertEquals(http.urlopen.call_count, 2)
+
+                # blocking queries always go to consul
+                self.do._kv_get('current_version', index=7, wait=10)
+                self.assertEquals(http.urlopen.call_count, 3)
+
+                # and writes drop the snapshot
+                with self.do.snapshot():
+                    self.do._txn([self.do._kv_op('delete', 'current_version')])
+                self.do._kv_get('current_version')
+                self.assertEquals(http.urlopen.call_count, 5)
+            self.do._kv_get('current_version')
+            self.assertEquals(http.urlopen.call_count, 6)
+
+    def test_request_datacenter(self):
+        do = DeploymentOrchestrator('somehost', 10000, datacenter='dc2')
+        with mock.patch.object(do, '_http') as http:
+            http.urlopen.return_value.status = 200
+            http.urlopen.return_value.data = ''
+            do._request('GET', 'kv/running_version/', {'keys': None})
+            self.assertEquals(http.urlopen.call_args[0][1], '/v1/kv/running_version/?dc=dc2&keys')
+            do.in_datacenter('dc3')._request('PUT', 'txn', body='[]')
+            self.assertEquals(http.urlopen.call_args[0][1], '/v1/txn?dc=dc3')
+        self.assertEquals(do.datacenter, 'dc2')
+
+    def test_health_summary_merge(self):
+        merged = HealthSummary.merge([HealthSummary(self.checks[:2]),
+                                      HealthSummary(self.checks[2:])])
+        summary = HealthSummary(self.checks)
+        self.assertEquals(merged.as_dict(), summary.as_dict())
+
+    def test_merge_census(self):
+        self.assertEquals(self.do.merge_census([{'v1': set(['host1']), 'v2': set(['host2'])},
+                                                {'v2': set(['host3'])}]),
+                          {'v1': set(['host1']), 'v2': set(['host2', 'host3'])})
+
+    def test_across_datacenters(self):
+        def census(do):
+            return {'v1': set(['%s-host1' % do.datacenter]),
+                    do.datacenter == 'dc2' and 'v2' or 'v1': set(['%s-host2' % do.datacenter])}
+
+        with nested(mock.patch.object(DeploymentOrchestrator, 'version_census', autospec=True),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                    ) as (version_census, stdout):
+            version_census.side_effect = census
+            self.assertEquals(self.do.across_datacenters(['dc1', 'dc2'], lambda do: do.datacenter),
+                              {'dc1': 'dc1', 'dc2': 'dc2'})
+
+            self.assertEquals(orchestrate.main(['--dc', 'dc1,dc2', 'running_versions']), None)
+            self.assertEquals(stdout.getvalue(), 'dc1: v1\ndc2: v1 v2\nmerged: v1 v2\n')
+
+            stdout.truncate(0)
+            self.assertEquals(orchestrate.main(['--dc', 'dc1', '--dc', 'dc2',
+                                                'check_single_version', 'v1']), True)
+            self.assertEquals(stdout.getvalue(), 'dc1: single version\ndc2: mixed versions\n')
+
+    def test_get_failures_all_dcs(self):
+        summaries = {'dc1': HealthSummary(self.checks[:2]), 'dc2': HealthSummary(self.checks[2:])}
+        with nested(mock.patch.object(DeploymentOrchestrator, 'health_summary', autospec=True),
+                    mock.patch.object(DeploymentOrchestrator, 'datacenters'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO)
+                    ) as (health_summary, datacenters, stdout):
+            health_summary.side_effect = lambda do: summaries[do.datacenter]
+            datacenters.return_value = ['dc1', 'dc2']
+            self.assertEquals(orchestrate.main(['--all-dcs', 'get_failures', '--json']), True)
+            output = json.loads(stdout.getvalue())
+            self.assertEquals(output['merged'], HealthSummary(self.checks).as_dict())
+            self.assertEquals(output['datacenters']['dc2'], summaries['dc2'].as_dict())
+
+    def test_dc_single_datacenter_only(self):
+        with nested(mock.patch.object(DeploymentOrchestrator, 'current_version', autospec=True),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO),
+                    mock.patch('sys.stderr', new_callable=StringIO.StringIO)
+                    ) as (current_version, stdout, stderr):
+            current_version.side_effect = lambda do: do.datacenter
+            orchestrate.main(['--dc', 'dc2', 'current_version'])
+            self.assertEquals(stdout.getvalue(), 'dc2\n')
+            self.assertRaises(SystemExit, orchestrate.main, ['--dc', 'dc1,dc2', 'current_version'])
+
+    def test_local_health(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 3, [{'Name': 'puppet', 'Status': 'warning', 'Output': ''},
+                                             {'Name': 'disk', 'Status': 'warning', 'Output': ''},
+                                             {'Name': 'serf', 'Status': 'passing', 'Output': ''}])
+            self.assertEquals([x['Name'] for x in self.do.local_health('node1', server=True)],
+                              ['puppet'])
+            request.assert_called_with('GET', 'health/node/node1', index=None, wait=None)
+
+    def test_local_health_agent(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, None, {
+                'validation': {'CheckID': 'validation', 'Name': 'validation',
+                               'Status': 'warning', 'Output': ''},
+                'puppet': {'CheckID': 'puppet', 'Name': 'puppet',
+                           'Status': 'critical', 'Output': ''},
+                'disk': {'CheckID': 'disk', 'Name': 'disk', 'Status': 'warning', 'Output': ''}})
+            self.assertEquals([x['Name'] for x in self.do.local_health('node1')],
+                              ['puppet', 'validation'])
+            request.assert_called_once_with('GET', 'agent/checks')
+
+    def test_watch_local_health(self):
+        def checks(*statuses):
+            return dict((name, {'CheckID': name, 'Name': name, 'Status': status, 'Output': ''})
+                        for name, status in zip(('puppet', 'validation'), statuses))
+
+        with nested(mock.patch.object(self.do, '_request'),
+                    mock.patch('time.sleep')
+                    ) as (request, sleep):
+            request.side_effect = [(200, None, checks('passing', 'passing')),
+                                   (200, None, checks('passing', 'passing')),
+                                   IOError('Connection refused'),
+                                   (200, None, checks('warning', 'passing')),
+                                   (200, None, checks('critical', 'passing')),
+                                   (200, None, checks('passing', 'passing'))]
+            watch = self.do.watch_local_health(interval=3)
+            self.assertEquals(watch.next(), [])
+            self.assertEquals([x['Status'] for x in watch.next()], ['warning'])
+            self.assertEquals([x['Status'] for x in watch.next()], ['critical'])
+            self.assertEquals(watch.next(), [])
+            self.assertEquals(sleep.call_args_list,
+                              [mock.call(3), mock.call(3), mock.call(1), mock.call(3),
+                               mock.call(3)])
+
+    def test_watch_local_health_server(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.side_effect = [(200, 10, []),
+                                   (200, 12, [{'Name': 'puppet', 'Status': 'warning'}])]
+            watch = self.do.watch_local_health('node1', server=True, wait=30)
+            self.assertEquals(watch.next(), [])
+            self.assertEquals(watch.next(), [{'Name': 'puppet', 'Status': 'warning'}])
+            self.assertEquals(request.call_args_list,
+                              [mock.call('GET', 'health/node/node1', index=None, wait=30),
+                               mock.call('GET', 'health/node/node1', index=10, wait=30)])
+
     def test_trigger_update(self):
-        with mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.consul', new_callable=mock.PropertyMock) as consul:
+        with mock.patch.object(self.do, '_txn') as txn:
             self.do.trigger_update('v673')
 
-            consul.return_value.kv.set.assert_called_with('/current_version', 'v673')
+            txn.assert_called_once_with([self.do._kv_op('set', 'current_version', 'v673'),
+                                         self.do._kv_op('delete-tree', 'target_version/')])
+
+    def test_trigger_update_event(self):
+        with nested(mock.patch.object(self.do, '_txn'),
+                    mock.patch.object(self.do, '_request')
+                    ) as (txn, request):
+            self.do.trigger_update('v673', event=True)
+            self.assertTrue(txn.called)
+            request.assert_called_once_with('PUT', 'event/fire/jorc-update', body='v673')
+
+    def test_rollout_after_cancelled_rollout(self):
+        consul = FakeConsul()
+        consul.seed(4, ['v1'], current_version='v1')
+        port = consul.start()
+        self.addCleanup(consul.stop)
+        do = DeploymentOrchestrator('127.0.0.1', port)
+        self.addCleanup(do.http.close)
+
+        with mock.patch('sys.stdout', new_callable=StringIO.StringIO):
+            # nobody moves, so the rollout of v2 is given up
+            self.assertFalse(do.rollout('v2', ['host0', 'host1'], timeout=1, wait=1))
+        self.assertEquals(do.current_version('host0'), 'v2')
+        do.trigger_update('v1')
+        self.assertEquals(do.current_version('host0'), 'v1')
+        self.assertFalse([k for k in consul.kv if k.startswith('target_version/')])
+
+        # targets left behind by a rollout that was given up without
+        # trigger_update do not survive into the next one either
+        with mock.patch('sys.stdout', new_callable=StringIO.StringIO):
+            self.assertFalse(do.rollout('v2', ['host0', 'host1'], timeout=1, wait=1))
+            self.assertFalse(do.rollout('v3', ['host2', 'host3'], timeout=1, wait=1))
+        self.assertEquals(do.current_version('host0'), 'v1')
+        self.assertEquals(do.current_version('host2'), 'v3')
+
+    def test_writes_drop_snapshot(self):
+        with mock.patch.object(self.do, '_http') as http:
+            http.urlopen.return_value.status = 200
+            http.urlopen.return_value.data = '[{"Key": "current_version", "Value": "djEy"}]'
+            http.urlopen.return_value.getheader.return_value = '7'
+            with self.do.snapshot():
+                self.do.current_version()
+                self.do.trigger_update('v13')
+                self.do.current_version()
+                self.do.update_own_status('host1', 'puppet', 0)
+                self.do.current_version()
+            self.assertEquals([c[0][0] for c in http.urlopen.call_args_list],
+                              ['GET', 'PUT', 'GET', 'PUT', 'GET'])
+
+    def test_handle_update_events(self):
+        events = [{'ID': 'a', 'Name': 'jorc-update', 'Payload': 'djEy', 'LTime': 4},
+                  {'ID': 'b', 'Name': 'jorc-update', 'Payload': 'djEz', 'LTime': 7},
+                  {'ID': 'c', 'Name': 'other', 'Payload': 'djE0', 'LTime': 9}]
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        state_path = os.path.join(tmpdir, 'last_event')
+        with nested(mock.patch.object(self.do, 'local_version'),
+                    mock.patch('subprocess.call')
+                    ) as (local_version, call):
+            local_version.return_value = 'v12'
+            # a failed hook is tried again when the events come again
+            call.return_value = 1
+            self.assertEquals(self.do.handle_update_events(events, 'puppet-apply --now', state_path),
+                              ('v13', 1))
+            self.assertFalse(os.path.exists(state_path))
+            call.return_value = 0
+            self.assertEquals(self.do.handle_update_events(events, 'puppet-apply --now', state_path),
+                              ('v13', 0))
+            self.assertEquals(call.call_args_list, [mock.call(['puppet-apply', '--now', 'v13'])] * 2)
+            with open(state_path) as fp:
+                self.assertEquals(fp.read(), '7')
+
+            # the watch passes the same events again
+            call.reset_mock()
+            self.assertEquals(self.do.handle_update_events(events, 'puppet-apply', state_path),
+                              (None, 0))
+            self.assertFalse(call.called)
+
+            # already at the announced version
+            local_version.return_value = 'v13'
+            self.assertEquals(self.do.handle_update_events(events[:2], 'puppet-apply'), (None, 0))
+            self.assertEquals(self.do.handle_update_events([], 'puppet-apply'), (None, 0))
+            self.assertFalse(call.called)
+
+    def test_main_handle_event(self):
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator'),
+                    mock.patch('sys.stdin', new_callable=StringIO.StringIO)
+                    ) as (do_class, stdin):
+            do_class.return_value.handle_update_events.return_value = ('v13', 3)
+            stdin.write('[]')
+            stdin.seek(0)
+            self.assertEquals(orchestrate.main(['handle_event', '--hook', 'false']), 3)
+
+    def test_kv_get(self):
+        with mock.patch.object(self.do, '_request') as request:
+            request.return_value = (200, 42, [{'Key': 'current_version',
+                                               'Value': 'djY3Mw==',
+                                               'ModifyIndex': 42}])
+            entry, index = self.do._kv_get('/current_version')
+            self.assertEquals(entry['Value'], 'v673')
+            self.assertEquals(index, 42)
+            request.assert_called_with('GET', 'kv/current_version', index=None, wait=None)
+
+            self.do._kv_get('/current_version', 42, 300)
+            request.assert_called_with('GET', 'kv/current_version', index=42, wait=300)
+
+            request.return_value = (404, 43, None)
+            self.assertEquals(self.do._kv_get('/current_version'), (None, 43))
+
+    def test_watch_update(self):
+        with nested(mock.patch.object(self.do, 'local_version'),
+                    mock.patch.object(self.do, '_kv_get')
+                    ) as (local_version, kv_get):
+            local_version.return_value = 'v1'
+            kv_get.side_effect = [({'Value': 'v1'}, 10),
+                                  ({'Value': 'v1'}, 10),
+                                  ({'Value': 'v2\n'}, 11)]
+            self.assertEquals(self.do.watch_update(wait=60), 'v2')
+            self.assertEquals(kv_get.call_args_list,
+                              [mock.call('/current_version', None, 60),
+                               mock.call('/current_version', 10, 60),
+                               mock.call('/current_version', 10, 60)])
+
+    def test_watch_update_hook(self):
+        with nested(mock.patch.object(self.do, 'local_version'),
+                    mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('subprocess.call')
+                    ) as (local_version, kv_get, call):
+            local_version.return_value = 'v1'
+            kv_get.side_effect = [({'Value': 'v2'}, 10),
+                                  ({'Value': 'v2'}, 12),
+                                  KeyboardInterrupt]
+            call.return_value = 0
+            self.assertRaises(KeyboardInterrupt, self.do.watch_update, 'update.sh -x')
+            call.assert_called_once_with(['update.sh', '-x', 'v2'])
+
+    def test_watch_update_hook_fails(self):
+        with nested(mock.patch.object(self.do, 'local_version'),
+                    mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('subprocess.call')
+                    ) as (local_version, kv_get, call):
+            local_version.return_value = 'v1'
+            kv_get.side_effect = [({'Value': 'v2'}, 10),
+                                  ({'Value': 'v2'}, 10),
+                                  ({'Value': 'v2'}, 10),
+                                  KeyboardInterrupt]
+            call.side_effect = [1, 0]
+            self.assertRaises(KeyboardInterrupt, self.do.watch_update, 'update.sh')
+            # retried after failing, then left alone once it worked
+            self.assertEquals(call.call_args_list, [mock.call(['update.sh', 'v2'])] * 2)
+
+    def test_watch_update_connection_error(self):
+        with nested(mock.patch.object(self.do, 'local_version'),
+                    mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.sleep')
+                    ) as (local_version, kv_get, sleep):
+            local_version.return_value = 'v1'
+            kv_get.side_effect = [({'Value': 'v1'}, 10),
+                                  IOError,
+                                  ({'Value': 'v2'}, 11)]
+            self.assertEquals(self.do.watch_update(wait=60), 'v2')
+            # after an error we start over with a non-blocking read
+            self.assertEquals(kv_get.call_args_list[-1], mock.call('/current_version', None, 60))
+            sleep.assert_called_once_with(1)
+
+
+class CommandServerTests(unittest.TestCase):
+    def setUp(self):
+        super(CommandServerTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'jorc.sock')
+        self.server = orchestrate_daemon.CommandServer(self.path)
+        self.do = mock.MagicMock()
+        patcher = mock.patch('jiocloud.orchestrate.DeploymentOrchestrator')
+        patcher.start().return_value = self.do
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+        super(CommandServerTests, self).tearDown()
+
+    def test_exit_code(self):
+        self.assertEquals(orchestrate.exit_code(None), 0)
+        self.assertEquals(orchestrate.exit_code(True), 1)
+        self.assertEquals(orchestrate.exit_code(False), 0)
+        self.assertEquals(orchestrate.exit_code(3), 3)
+        self.assertEquals(orchestrate.exit_code('error'), 1)
+
+    def test_run(self):
+        self.do.current_version.return_value = 'v1'
+        self.assertEquals(self.server.run(['current_version']),
+                          {'rc': 0, 'stdout': 'v1\n', 'stderr': ''})
+
+        self.do.check_single_version.return_value = False
+        self.assertEquals(self.server.run(['check_single_version', 'v1'])['rc'], 1)
+
+        self.do.verify_hosts.return_value = True
+        self.assertEquals(self.server.run(['verify_hosts', 'v1'], 'host1\nhost2\n')['rc'], 0)
+        self.do.verify_hosts.assert_called_with('v1', ['host1', 'host2'])
+
+    def test_update_own_status(self):
+        self.do.own_status.return_value = 'warn'
+        with mock.patch.object(orchestrate_daemon.StatusReporter, 'run'):
+            self.assertEquals(self.server.run(['update_own_status', '--hostname', 'host1',
+                                               'puppet', '4'])['rc'], 0)
+            self.do.check_ttl.assert_called_once_with('puppet', 'warn')
+            self.assertFalse(self.do.update_own_status.called)
+            self.assertEquals(self.do.status_reporter.states, {'puppet': 'warn'})
+
+            # an agent that can not be told is an error
+            self.do.own_status.return_value = 'pass'
+            self.do.check_ttl.side_effect = IOError('Connection refused')
+            self.assertEquals(self.server.run(['update_own_status', '--hostname', 'host1',
+                                               'puppet', '0'])['rc'], 1)
+        self.assertEquals(self.do.status_reporter.keepalive,
+                          orchestrate_daemon.StatusReporter.KEEPALIVE)
+
+    def test_keepalive(self):
+        self.server.keepalive = 10
+        with mock.patch.object(orchestrate_daemon.StatusReporter, 'run'):
+            self.server.run(['update_own_status', '--hostname', 'host1', 'puppet', '0'])
+        self.assertEquals(self.do.status_reporter.keepalive, 10)
+
+        with mock.patch('jiocloud.orchestrate_daemon.CommandServer') as server_class:
+            server_class.return_value.server_address = os.path.join(self.tmpdir, 'other.sock')
+            open(server_class.return_value.server_address, 'w').close()
+            orchestrate.main(['--socket', self.path, 'serve', '--keepalive', '10'])
+            server_class.assert_called_once_with(self.path, 10)
+
+    def test_run_errors(self):
+        self.assertEquals(self.server.run(['no_such_command'])['rc'], 2)
+        self.assertEquals(self.server.run(['serve'])['rc'], 2)
+        self.assertEquals(self.server.run(['local_health', '--watch'])['rc'], 2)
+        self.do.current_version.side_effect = ValueError
+        response = self.server.run(['current_version'])
+        self.assertEquals(response['rc'], 1)
+        self.assertTrue('ValueError' in response['stderr'])
+
+    def test_forward(self):
+        self.do.get_failures.return_value = False
+        thread = threading.Thread(target=self.server.handle_request)
+        thread.start()
+        with mock.patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            self.do.health_summary.return_value.healthy.return_value = False
+            self.do.health_summary.return_value.as_dict.return_value = {'healthy': False}
+            rc = orchestrate.main(['--socket', self.path, 'get_failures', '--json'])
+        thread.join()
+        self.assertEquals(rc, 1)
+        self.assertEquals(stdout.getvalue(), '{"healthy": false}\n')
+
+    def test_forward_no_daemon(self):
+        with mock.patch('sys.stdout', new_callable=StringIO.StringIO) as stdout:
+            self.do.local_version.return_value = 'v2'
+            rc = orchestrate.main(['--socket', os.path.join(self.tmpdir, 'missing'),
+                                   'local_version'])
+        self.assertEquals(rc, None)
+        self.assertEquals(stdout.getvalue(), 'v2\n')
+
+
+class StatusReporterTests(unittest.TestCase):
+    def setUp(self):
+        super(StatusReporterTests, self).setUp()
+        self.do = DeploymentOrchestrator()
+        self.reporter = orchestrate_daemon.StatusReporter(self.do, keepalive=30)
+        for patcher in (mock.patch.object(self.do, 'check_ttl'),
+                        mock.patch.object(orchestrate_daemon.StatusReporter, 'run')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def update_own_status(self, now, status_type, status_result):
+        with mock.patch('time.time') as time:
+            time.return_value = now
+            self.reporter.update_own_status('host1', status_type, status_result)
+
+    def test_coalesce(self):
+        self.update_own_status(1000, 'puppet', 0)
+        self.update_own_status(1000, 'validation', 0)
+        self.assertEquals(self.do.check_ttl.call_args_list,
+                          [mock.call('puppet', 'pass'), mock.call('validation', 'pass')])
+
+        # the same results again are not sent until the keepalive
+        self.do.check_ttl.reset_mock()
+        self.update_own_status(1010, 'puppet', 2)
+        self.assertEquals(self.reporter.flush(now=1010), 20)
+        self.assertFalse(self.do.check_ttl.called)
+
+        # but a change is, right away
+        self.update_own_status(1011, 'puppet', 6)
+        self.update_own_status(1011, 'puppet', 4)
+        self.do.check_ttl.assert_called_once_with('puppet', 'warn')
+        self.assertEquals(self.reporter.flush(now=1011), 19)
+
+    def test_keepalive(self):
+        self.update_own_status(1000, 'puppet', 0)
+        self.update_own_status(1020, 'validation', 1)
+        self.do.check_ttl.reset_mock()
+
+        self.assertEquals(self.reporter.flush(now=1030), 20)
+        self.do.check_ttl.assert_called_once_with('puppet', 'pass')
+        self.reporter.flush(now=1050)
+        self.do.check_ttl.assert_called_with('validation', 'warn')
+
+    def test_retry(self):
+        self.update_own_status(1000, 'puppet', 0)
+        self.do.check_ttl.side_effect = [IOError('Connection refused'), None]
+        with mock.patch('sys.__stderr__', new_callable=StringIO.StringIO):
+            self.assertEquals(self.reporter.flush(now=1030), self.reporter.RETRY)
+        self.assertEquals(self.reporter.flush(now=1035), 30)
+        self.assertEquals(self.do.check_ttl.call_count, 3)
+
+    def test_change_fails(self):
+        self.update_own_status(1000, 'puppet', 0)
+        self.do.check_ttl.side_effect = IOError('Connection refused')
+        self.assertRaises(IOError, self.update_own_status, 1010, 'puppet', 4)
+        # the agent still has the old state, so that is what is kept alive
+        self.assertEquals(self.reporter.states, {'puppet': 'pass'})
+        self.do.check_ttl.side_effect = None
+        self.update_own_status(1020, 'puppet', 4)
+        self.do.check_ttl.assert_called_with('puppet', 'warn')
+
+    def test_invalid_status_type(self):
+        self.assertRaises(Exception, self.reporter.update_own_status, 'host1', 'disk', 0)
+        self.assertEquals(self.reporter.states, {})
+
+
+class VersionCacheTests(unittest.TestCase):
+    def setUp(self):
+        super(VersionCacheTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'current_version')
+        self.do = DeploymentOrchestrator('somehost', 10000,
+                                         cache_path=self.cache_path,
+                                         cache_ttl=60, max_stale=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(VersionCacheTests, self).tearDown()
+
+    def write_cache(self, value, index, checked, flags=0):
+        with open(self.cache_path, 'w') as fp:
+            json.dump({'entry': {'Value': value, 'Flags': flags},
+                       'index': index, 'checked': checked}, fp)
+
+    def test_fresh_cache(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.time')
+                    ) as (kv_get, time):
+            time.return_value = 1000
+            self.write_cache('v1', 10, 990)
+            self.assertEquals(self.do.current_version(), 'v1')
+            self.assertFalse(kv_get.called)
+
+    def test_revalidate(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.time')
+                    ) as (kv_get, time):
+            time.return_value = 1000
+            self.write_cache('v1', 10, 900)
+            kv_get.return_value = ({'Value': 'v2'}, 12)
+            self.assertEquals(self.do.current_version(), 'v2')
+            self.assertEquals(json.load(open(self.cache_path)),
+                              {'entry': {'Value': 'v2', 'Flags': 0},
+                               'index': 12, 'checked': 1000})
+
+    def test_old_format(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.time')
+                    ) as (kv_get, time):
+            time.return_value = 1000
+            with open(self.cache_path, 'w') as fp:
+                json.dump({'value': 'v1', 'index': 10, 'checked': 990}, fp)
+            kv_get.return_value = ({'Value': 'v2'}, 12)
+            self.assertEquals(self.do.current_version(), 'v2')
+
+    def test_rollout_in_progress(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.time')
+                    ) as (kv_get, time):
+            time.return_value = 1000
+            kv_get.side_effect = lambda key: {
+                '/current_version': ({'Value': 'v1', 'Flags': 1}, 12),
+                '/target_version/node1': ({'Value': 'v2'}, 13)}[key]
+            self.assertEquals(self.do.current_version(), 'v1')
+            # served from the cache, but node1's target is still looked up
+            self.assertEquals(self.do.current_version('node1'), 'v2')
+            self.assertEquals(self.do.current_version(), 'v1')
+            self.assertEquals(kv_get.call_args_list,
+                              [mock.call('/current_version'),
+                               mock.call('/target_version/node1')])
+
+            kv_get.side_effect = IOError
+            time.return_value = 1100
+            self.assertEquals(self.do.current_version(), 'v1')
+            self.assertRaises(IOError, self.do.current_version, 'node1')
+
+    def test_older_index_ignored(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.time')
+                    ) as (kv_get, time):
+            time.return_value = 1000
+            self.do.consistency = 'stale'
+            self.write_cache('v2', 12, 900)
+            kv_get.return_value = ({'Value': 'v1'}, 10)
+            self.assertEquals(self.do.current_version(), 'v2')
+
+    def test_index_reset(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch('time.time')
+                    ) as (kv_get, time):
+            time.return_value = 1000
+            self.write_cache('v1', 5000, 900)
+            kv_get.return_value = ({'Value': 'v2'}, 10)
+            self.assertEquals(self.do.current_version(), 'v2')
+            self.assertEquals(json.load(open(self.cache_path))['index'], 10)
+
+            # even reading from followers, a step back that big is a reset
+            self.do.consistency = 'stale'
+            self.write_cache('v1', 5000, 900)
+            self.assertEquals(self.do.current_version(), 'v2')
+
+            # while a read from the leader always wins
+            self.do.consistency = 'default'
+            self.write_cache('v1', 12, 900)
+            self.assertEquals(self.do.current_version(), 'v2')
+
+    def test_unreachable(self):
+        with nested(mock.patch.object(self.do, '_kv_get'),
+                    mock.patch.object(self.do, 'local_version'),
+                    mock.patch('time.time')
+                    ) as (kv_get, local_version, time):
+            kv_get.side_effect = IOError
+            local_version.return_value = 'v1'
+            self.write_cache('v2', 12, 900)
+
+            time.return_value = 1000
+            self.assertEquals(self.do.pending_update(), self.do.UPDATE_AVAILABLE)
+
+            time.return_value = 900 + 3601
+            self.assertEquals(self.do.pending_update(), self.do.NO_CLUE)
+
+    def test_no_cache(self):
+        with mock.patch.object(self.do, '_kv_get') as kv_get:
+            kv_get.side_effect = IOError
+            self.assertRaises(IOError, self.do.current_version)
+
+
+class ConsulMetricsTests(unittest.TestCase):
+    def setUp(self):
+        super(ConsulMetricsTests, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.metrics = ConsulMetrics('pending_update')
+        self.metrics.record('GET kv/current_version', 0.003, 120)
+        self.metrics.record('GET kv/current_version', 0.2, 120, error=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        super(ConsulMetricsTests, self).tearDown()
+
+    def test_endpoint_name(self):
+        self.assertEquals(ConsulMetrics.endpoint_name('GET', 'kv/running_version/'),
+                          'GET kv/running_version')
+        self.assertEquals(ConsulMetrics.endpoint_name('GET', 'health/node/node1'),
+                          'GET health/node')
+        self.assertEquals(ConsulMetrics.endpoint_name('PUT', 'txn'), 'PUT txn')
+
+    def test_summary(self):
+        self.assertEquals(self.metrics.summary(),
+                          'Consul calls for pending_update:\n'
+                          '  GET kv/current_version: 2 calls, 1 errors, 240 bytes, 203.0ms total, 200.0ms max\n')
 
+    def test_write_textfile(self):
+        path = os.path.join(self.tmpdir, 'jorc.prom')
+        self.metrics.write_textfile(path)
+        self.metrics.write_textfile(path)
+        lines = open(path).read().splitlines()
+        labels = 'subcommand="pending_update",endpoint="GET kv/current_version"'
+        self.assertTrue('# TYPE jorc_consul_request_duration_seconds histogram' in lines)
+        self.assertTrue('jorc_consul_requests_total{%s} 4' % labels in lines)
+        self.assertTrue('jorc_consul_request_errors_total{%s} 2' % labels in lines)
+        self.assertTrue('jorc_consul_response_bytes_total{%s} 480' % labels in lines)
+        self.assertTrue('jorc_consul_request_duration_seconds_bucket{%s,le="0.005"} 2' % labels in lines)
+        self.assertTrue('jorc_consul_request_duration_seconds_bucket{%s,le="0.1"} 2' % labels in lines)
+        self.assertTrue('jorc_consul_request_duration_seconds_bucket{%s,le="0.25"} 4' % labels in lines)
+        self.assertTrue('jorc_consul_request_duration_seconds_bucket{%s,le="+Inf"} 4' % labels in lines)
+        self.assertTrue('jorc_consul_request_duration_seconds_count{%s} 4' % labels in lines)
 
+        # buckets in increasing order, then the sum and count
+        histogram = [l.rsplit(' ', 1)[0] for l in lines
+                     if l.startswith('jorc_consul_request_duration_seconds_')]
+        self.assertEquals(histogram,
+                          ['jorc_consul_request_duration_seconds_bucket{%s,le="%s"}' % (labels, bound)
+                           for bound in ConsulMetrics.BUCKETS + ('+Inf',)] +
+                          ['jorc_consul_request_duration_seconds_sum{%s}' % labels,
+                           'jorc_consul_request_duration_seconds_count{%s}' % labels])
 
+    def test_timings_flag(self):
+        with nested(mock.patch('jiocloud.orchestrate.DeploymentOrchestrator.local_version'),
+                    mock.patch('sys.stdout', new_callable=StringIO.StringIO),
+                    mock.patch('sys.stderr', new_callable=StringIO.StringIO)
+                    ) as (local_version, stdout, stderr):
+            local_version.return_value = 'v1'
+            orchestrate.main(['--timings', 'local_version'])
+            self.assertEquals(stderr.getvalue(), 'Consul calls for local_version:\n  none\n')
@@ -0,0 +1,91 @@
+#    Copyright Reliance Jio Infocomm, Ltd.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+"""
+Startup cost of the jorc entry point. Each subcommand is run in a fresh
+interpreter with every import timed (in the spirit of python -X importtime)
+and the report is printed, so run with nosetests -s to see it.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import jiocloud
+
+# Modules no subcommand that stays off the network should pay for
+HEAVY_MODULES = ('consulate', 'requests', 'urllib3', 'yaml', 'netifaces')
+
+CHILD = r'''
+import __builtin__, json, sys, time
+real_import = __builtin__.__import__
+imports = []
+depth = [0]
+def timed_import(name, *args, **kwargs):
+    start = time.time()
+    depth[0] += 1
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        imports.append((depth[0], name, time.time() - start))
+__builtin__.__import__ = timed_import
+from jiocloud import orchestrate
+try:
+    orchestrate.main(sys.argv[2:])
+except SystemExit:
+    pass
+__builtin__.__import__ = real_import
+with open(sys.argv[1], 'w') as fp:
+    json.dump({'imports': imports, 'modules': sorted(sys.modules)}, fp)
+'''
+
+
+class StartupTests(unittest.TestCase):
+    def run_jorc(self, *argv):
+        fd, report_path = tempfile.mkstemp()
+        os.close(fd)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(jiocloud.__file__))
+        try:
+            start = time.time()
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call([sys.executable, '-c', CHILD, report_path] + list(argv),
+                                stdout=devnull, stderr=devnull, env=env)
+            elapsed = time.time() - start
+            with open(report_path) as fp:
+                report = json.load(fp)
+        finally:
+            os.unlink(report_path)
+
+        print 'jorc %s: %.1fms wall clock' % (' '.join(argv), elapsed * 1000)
+        print '  cumulative(ms) | imported package'
+        for level, name, seconds in report['imports']:
+            if seconds >= 0.001:
+                print '  %14.1f | %s%s' % (seconds * 1000, '  ' * level, name or '.')
+        return report
+
+    def test_local_version_stays_light(self):
+        report = self.run_jorc('local_version')
+        heavy = [m for m in report['modules'] if m.split('.')[0] in HEAVY_MODULES]
+        self.assertEquals(heavy, [])
+
+    def test_pending_update(self):
+        # Nothing listens on port 1, so this measures startup plus a
+        # refused connection.
+        report = self.run_jorc('--port', '1', 'pending_update')
+        self.assertTrue('jiocloud.orchestrate' in report['modules'])
@@ -26,16 +26,35 @@ def is_rfc1918(ip_string):
 def is_ipv4(ip_string):
     return IPy.IP(ip_string).version() == 4
 
-def get_ip_of_node(nova_client, name):
+def pick_ip(server):
+    """
+    The address to reach server on: its first public IPv4 address, if it
+    has one
+    """
     ip = None
+    for network in server.networks.values():
+        for ip in network:
+            if is_ipv4(ip) and not is_rfc1918(ip):
+                return ip
+    # Fallthrough... If none are non-rfc1918 just return whatever
+    return ip
+
+def get_ip_index(nova_client):
+    """
+    Map the name of every server to its address (see pick_ip), from a
+    single server list. Where names clash, the first server listed wins,
+    as with get_ip_of_node.
+    """
+    index = {}
+    for server in nova_client.servers.list():
+        if server.name not in index:
+            index[server.name] = pick_ip(server)
+    return index
+
+def get_ip_of_node(nova_client, name):
     for server in nova_client.servers.list():
         if server.name == name:
-            for network in server.networks.values():
-                for ip in network:
-                    if is_ipv4(ip) and not is_rfc1918(ip):
-                        return ip
-            # Fallthrough... If none are non-rfc1918 just return whatever
-            return ip
+            return pick_ip(server)
     raise Exception('Server not found')
 
 if __name__ == '__main__':